@@ -4,40 +4,51 @@ import datetime
 import logging
 import sys
 import traceback
-from multiprocessing.pool import ThreadPool
-import multiprocessing
 from threading import Thread
 
 from apscheduler.schedulers.blocking import BlockingScheduler
 
-from scrapper import run, contador
+from scrapper import run, contador, cycles, orchestrator, work_queue
 
 
-def scheduler_config(fn, args, start):
-    return {
+def scheduler_config(fn, args, start=None):
+    minutes = contador.get_config()["script"]["frecuencia [minutos]"]
+    config = {
         "func": fn,
         "args": args,
         "trigger": "interval",
-        "minutes": contador.get_config()["script"]["frecuencia [minutos]"],
-        "next_run_time": start,
+        "minutes": minutes,
+        # cycles run on wall clock multiples of the interval, so that every user keeps
+        # its stagger slot across restarts
+        "start_date": orchestrator.interval_start(minutes),
+        "id": "contador",
+        # a cycle still running makes the next one be skipped (and recorded), never
+        # overlap; runs missed while busy are merged into one
+        "max_instances": 1,
+        "coalesce": True,
+        "misfire_grace_time": 60,
     }
+    if start is not None:
+        config["next_run_time"] = start
+    return config
 
 
 if __name__ == "__main__":
     scheduler = BlockingScheduler()
+    cycles.watch(scheduler, "contador", contador.cycle_planner)
     try:
         mode = sys.argv[1]
         if mode == "multiple":
-            workers = multiprocessing.cpu_count()
-            pool = ThreadPool(workers)
             users = None
-            scheduler.add_job(
-                **scheduler_config(
-                    run.multiple, (pool, users, True), datetime.datetime.now()
-                )
-            )
+            scheduler.add_job(**scheduler_config(run.multiple, (users, True)))
 
             scheduler.start()
+        elif mode == "queue":
+            # only fill the queue, the readings are done by the workers
+            scheduler.add_job(**scheduler_config(work_queue.enqueue_cycle, None))
+            scheduler.start()
+        elif mode == "worker":
+            work_queue.work()
         else:
             contador.info_log.error(f"mode value error: can't be <{mode}>")
     except IndexError:
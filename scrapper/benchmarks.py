@@ -0,0 +1,77 @@
+"""Micro-benchmarks of the scrapper hot paths.
+
+Usage:
+    python -m scrapper.benchmarks [snapshots dir]
+
+Page snapshots are `*.html` files saved with `driver.page_source` after a reading. When
+there aren't any, a synthetic page of the same size as the portal one is used.
+"""
+
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Callable, List
+
+from scrapper.contador import _parse_values_bs4, parse_values
+
+SNAPSHOTS = Path(__file__).parent / "snapshots"
+
+VALUES = (
+    '<div class="slds-col description"><span>Potencia Instantánea Actual</span>'
+    "<span>1,22 kW</span></div>"
+    '<div class="slds-col percent"><span>36,97%</span></div>'
+    '<div class="slds-col max"><span>3,3 kW</span><span>Potencia contratada</span></div>'
+)
+FILLER = (
+    '<div class="slds-grid slds-wrap forceCommunityThemeLayout" data-aura-rendered-by="{n}'
+    ':0"><span class="uiOutputText" data-aura-class="uiOutputText">Elemento {n}</span>'
+    '<button class="slds-button slds-button_neutral" title="Accion {n}">Accion</button>'
+    "</div>\n"
+)
+
+
+def synthetic_page(size: int = 1_500_000) -> str:
+    """Salesforce like page, the values are in the middle of it."""
+    filler = "".join(FILLER.format(n=n) for n in range(size // len(FILLER) // 2))
+    return f"<html><body>{filler}{VALUES}{filler}</body></html>"
+
+
+def load_snapshots(path: Path = SNAPSHOTS) -> List[str]:
+    pages = [f.read_text() for f in sorted(path.glob("*.html"))]
+    return pages or [synthetic_page()]
+
+
+def measure(fn: Callable, pages: List[str], repeat: int = 5) -> dict:
+    """Best time and peak of memory allocated per page."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for page in pages:
+            fn(page)
+        best = min(best, (time.perf_counter() - start) / len(pages))
+    tracemalloc.start()
+    for page in pages:
+        fn(page)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"ms": best * 1000, "peak_kb": peak / 1024}
+
+
+def bench_parse(pages: List[str]):
+    """Regex fast path vs full bs4 parse of the page."""
+    assert parse_values(pages[0]) == _parse_values_bs4(pages[0])
+    fast = measure(parse_values, pages)
+    full = measure(_parse_values_bs4, pages)
+    print(f"{len(pages)} pagina(s), {sum(map(len, pages)) // len(pages) // 1024} kB")
+    print(f"{'':<10}{'ms/pagina':>12}{'pico kB':>12}")
+    for name, res in (("bs4", full), ("regex", fast)):
+        print(f"{name:<10}{res['ms']:>12.2f}{res['peak_kb']:>12.0f}")
+    print(
+        f"x{full['ms'] / fast['ms']:.0f} mas rapido, "
+        f"x{full['peak_kb'] / max(fast['peak_kb'], 1):.0f} menos memoria"
+    )
+
+
+if __name__ == "__main__":
+    bench_parse(load_snapshots(Path(sys.argv[1]) if len(sys.argv) > 1 else SNAPSHOTS))
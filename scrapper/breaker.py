@@ -0,0 +1,97 @@
+"""Circuit breaker shared by all the readings, to stop reading while the portal is down.
+
+While the portal fails most of the readings there is no point on opening browsers and
+waiting out the timeouts for every user. The breaker opens after too many failures,
+rejects the readings for a while and then lets a single one through to probe the portal.
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class CircuitBreaker:
+    """Open when `failure_rate` of the last `window` readings failed.
+
+    Each user counts once in the window, with its last outcome, so its retries or a
+    few users that always fail (wrong password) can't stop the readings of everyone.
+
+    After `cooldown` seconds open, one probe reading is allowed. If it succeeds the breaker
+    closes, otherwise it opens again for twice the time, up to `max_cooldown`.
+    """
+
+    window: int = 10
+    min_calls: int = 5
+    failure_rate: float = 0.5
+    cooldown: float = 60
+    max_cooldown: float = 600
+    state: str = CLOSED
+    _outcomes: deque = field(default=None, init=False, repr=False)
+    _opened: float = field(default=0.0, init=False, repr=False)
+    _wait: float = field(default=0.0, init=False, repr=False)
+    _probing: bool = field(default=False, init=False, repr=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock, init=False)
+
+    def __post_init__(self):
+        self._outcomes = deque(maxlen=self.window)
+        self._wait = self.cooldown
+
+    def allow(self) -> bool:
+        """Whether a reading can start now. A True in half open state is the probe, and
+        its result must be given back with `record`."""
+        with self._lock:
+            if self.state == OPEN and time.monotonic() - self._opened >= self._wait:
+                self.state = HALF_OPEN
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def retry_after(self) -> float:
+        """Seconds until a reading may be allowed again."""
+        with self._lock:
+            if self.state == OPEN:
+                return max(self._opened + self._wait - time.monotonic(), 0)
+            return 1.0 if self._probing else 0
+
+    def record(self, succeed: bool, user: str = None):
+        """Result of an allowed reading of `user`, None when it didn't get to an end."""
+        with self._lock:
+            if self.state == HALF_OPEN and self._probing:
+                self._probing = False
+                if succeed:
+                    log.info("Portal recuperado, reanudando lecturas")
+                    self.state = CLOSED
+                    self._outcomes.clear()
+                    self._wait = self.cooldown
+                elif succeed is False:
+                    self._open(min(self._wait * 2, self.max_cooldown))
+                return
+            if succeed is None or self.state != CLOSED:
+                return
+            if user is not None:
+                earlier = [o for o in self._outcomes if o[0] == user]
+                for outcome in earlier:
+                    self._outcomes.remove(outcome)
+            self._outcomes.append((user, succeed))
+            failed = sum(1 for _, ok in self._outcomes if not ok)
+            if (
+                len(self._outcomes) >= self.min_calls
+                and failed / len(self._outcomes) >= self.failure_rate
+            ):
+                self._open(self.cooldown)
+
+    def _open(self, wait: float):
+        log.error(f"Portal con errores, lecturas paradas durante {wait:.0f}s")
+        self.state = OPEN
+        self._opened = time.monotonic()
+        self._wait = wait
@@ -0,0 +1,76 @@
+"""Number of concurrent readings adjusted after every cycle.
+
+The concurrency grows by one reader per cycle while the portal answers fast and without
+errors, and is halved as soon as the readings get slow or start failing. It never goes
+over what the free memory allows, so small boards don't swap.
+"""
+
+from dataclasses import dataclass
+from statistics import median
+from typing import List
+
+from scrapper.metrics import percentile
+
+
+def available_memory_mb() -> float:
+    """Memory available for new processes without swapping, in MB. Linux only."""
+    try:
+        with open("/proc/meminfo") as f:
+            meminfo = dict(line.split(":", 1) for line in f)
+    except OSError:
+        return None
+    return int(meminfo["MemAvailable"].split()[0]) / 1024
+
+
+@dataclass
+class ConcurrencyController:
+    """Additive increase, multiplicative decrease of the concurrent readings.
+
+    `reader_mb` is the memory taken by each reader, updated with the `rss_mb` measured on
+    the browsers, and `reserve_mb` the memory left for everything else.
+    """
+
+    current: int = 4
+    min_workers: int = 1
+    max_workers: int = 8
+    target_latency: float = 60
+    max_error_rate: float = 0.2
+    reader_mb: float = 300
+    reserve_mb: float = 200
+
+    def memory_limit(self, idle: int = 0) -> int:
+        """Readers that fit in the available memory. Idle pooled browsers are reused, so
+        their memory counts as available."""
+        available = available_memory_mb()
+        if available is None:
+            return self.max_workers
+        available += idle * self.reader_mb
+        return int((available - self.reserve_mb) // self.reader_mb)
+
+    def next(self, idle: int = 0) -> int:
+        """Concurrency for the next cycle, the one `update` adjusts afterwards."""
+        limit = min(self.current, self.memory_limit(idle))
+        self.current = max(self.min_workers, min(limit, self.max_workers))
+        return self.current
+
+    def update(self, results: List) -> int:
+        """Adjust the concurrency with the results of the last cycle."""
+        timings = [
+            read.timings
+            for _, values in results
+            for read in values.values()
+            # timeouts count with the time they ran, the ones not read don't count
+            if getattr(read, "timings", None) is not None and read.timings.phases
+        ]
+        if not timings:
+            return self.current
+        errors = sum(1 for t in timings if t.outcome != "ok") / len(timings)
+        latency = percentile(sorted(t.total for t in timings), 50)
+        rss = [t.gauges["rss_mb"] for t in timings if "rss_mb" in t.gauges]
+        if rss:
+            self.reader_mb = median(rss)
+        if errors > self.max_error_rate or latency > self.target_latency:
+            self.current = max(self.min_workers, self.current // 2)
+        else:
+            self.current = min(self.max_workers, self.current + 1)
+        return self.current
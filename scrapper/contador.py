@@ -1,15 +1,16 @@
 """Endesa e-distribution consume info scrapper."""
 
+import atexit
 import datetime
 import json
-import time
 from dataclasses import dataclass, field
 from pathlib import Path
-from collections import defaultdict
 from typing import Dict, Tuple
 import logging
 from dataclasses import dataclass
 import random
+import re
+import threading
 
 import bs4  # type: ignore
 
@@ -17,12 +18,30 @@ import bs4  # type: ignore
 from selenium import webdriver  # type: ignore
 from selenium.common.exceptions import (  # type: ignore
     ElementClickInterceptedException,
+    ElementNotInteractableException,
     NoSuchElementException,
+    TimeoutException,
+    WebDriverException,
 )
 from selenium.webdriver import FirefoxOptions  # type: ignore
 from selenium.webdriver import Firefox, FirefoxProfile
+from selenium.webdriver.common.by import By  # type: ignore
+from selenium.webdriver.support import expected_conditions as EC  # type: ignore
+from selenium.webdriver.support.ui import WebDriverWait  # type: ignore
+
+from scrapper import metrics
+from scrapper.breaker import CircuitBreaker
+from scrapper.concurrency import ConcurrencyController
+from scrapper.metrics import ReadTimings
+from scrapper.pool import DriverPool
+from scrapper.profile import lean_profile
+from scrapper.sessions import SessionStore
 
 base_path = Path(__file__).parent
+sessions = SessionStore(base_path / "sessions")
+
+LOGIN_URL = "https://zonaprivada.edistribucion.com/areaprivada/s/login/?language=es"
+HOME_URL = "https://zonaprivada.edistribucion.com/areaprivada/s/"
 
 
 @dataclass
@@ -33,6 +52,7 @@ class SingleReadData:
     power: float
     percent: float
     max_power: float
+    timings: ReadTimings = field(default=None, compare=False, repr=False)
 
     def to_tuple(self, format_data: bool = False):
         date = self.date
@@ -40,6 +60,14 @@ class SingleReadData:
             date = date.strftime("%d-%m-%Y_%H:%M:%S")  # type: ignore
         return (date, self.power, self.percent, self.max_power)
 
+    @classmethod
+    def from_tuple(cls, values) -> "SingleReadData":
+        """Inverse of `to_tuple`, the date may be formatted or not."""
+        date, power, percent, max_power = values
+        if isinstance(date, str):
+            date = datetime.datetime.strptime(date, "%d-%m-%Y_%H:%M:%S")
+        return cls(date, power, percent, max_power)
+
 
 @dataclass
 class UserAgent:
@@ -57,14 +85,18 @@ class UserAgent:
 # loggers
 #########################
 def info_logger():
-    """Info logging."""
-    info_log = logging.getLogger(__name__)
-    info_log.setLevel(logging.INFO)
+    """Info logging.
+
+    The handler is attached to the package logger so the other scrapper modules log
+    with the same format.
+    """
+    package_log = logging.getLogger(__package__)
+    package_log.setLevel(logging.INFO)
     handler = logging.StreamHandler()
     logger_formatter = logging.Formatter("[%(levelname)s] - %(message)s")
     handler.setFormatter(logger_formatter)
-    info_log.addHandler(handler)
-    return info_log
+    package_log.addHandler(handler)
+    return logging.getLogger(__name__)
 
 
 info_log = info_logger()
@@ -97,6 +129,41 @@ def _max_power(power: str) -> float:
     return _to_float(power)
 
 
+# Elements with the values shown after "Consultar Contador"
+EXTRACT_JS = """
+const text = (s) => { const el = document.querySelector(s); return el && el.textContent; };
+return [text('.description'), text('.percent'), text('.max > span:nth-child(1)')];
+"""
+_CLASS = r'class="(?:[^"]*\s)?{}(?:\s[^"]*)?"[^>]*>'
+DESCRIPTION_RE = re.compile(
+    _CLASS.format("description") + r".{0,400}?([\d.,]+)\s*kW", re.S
+)
+PERCENT_RE = re.compile(
+    _CLASS.format("percent") + r"(?:\s*<[^>]*>)*\s*([\d.,]+)\s*%"
+)
+MAX_RE = re.compile(_CLASS.format("max") + r"\s*<span[^>]*>\s*([\d.,]+)\s*kW")
+
+
+def parse_values(page: str) -> Tuple[float, float, float]:
+    """Get actual consume, percent and max power from a page source.
+
+    Precompiled regexes avoid parsing the whole page. If the markup doesn't match them
+    the page is parsed with bs4, which raises IndexError when values aren't there.
+    """
+    matches = [regex.search(page) for regex in (DESCRIPTION_RE, PERCENT_RE, MAX_RE)]
+    if all(matches):
+        return tuple(_to_float(match.group(1)) for match in matches)  # type: ignore
+    return _parse_values_bs4(page)
+
+
+def _parse_values_bs4(page: str) -> Tuple[float, float, float]:
+    soup = bs4.BeautifulSoup(page, features="html.parser")
+    actual_read = _actual_read(soup.select(".description")[0].text)
+    percent = _relative_percent(soup.select(".percent")[0].text)
+    max_power = _max_power(soup.select(".max > span:nth-child(1)")[0].text)
+    return actual_read, percent, max_power
+
+
 #########################
 # JSON Files
 #########################
@@ -115,35 +182,123 @@ def storage(type_) -> dict:
 
 
 def browser_setup():
-    """Set a driver object."""
+    """Set a driver object.
+
+    With `"lean": true` the profile is copied from a template that blocks images, media,
+    fonts and analytics, with a small memory cache.
+    """
     cfg = get_config()["browser"]
-    profile = FirefoxProfile()
+    profile = FirefoxProfile(lean_profile(cfg) if cfg.get("lean", False) else None)
     user_agent = UserAgent()
     profile.native_events_enabled = cfg["native_events_enabled"]
     profile.set_preference("general.useragent.override", user_agent.random)
     opts = FirefoxOptions()
     opts.headless = cfg["headless"]
-    driver = Firefox(options=opts, executable_path=cfg["gecko_driver"])
-    driver.implicitly_wait(cfg["timeout"])
+    driver = Firefox(
+        firefox_profile=profile, options=opts, executable_path=cfg["gecko_driver"]
+    )
+    # all the waits are explicit (see ReadConsumption.wait), an implicit wait would
+    # delay every poll
+    driver.implicitly_wait(0)
     return driver
 
 
+_driver_pool = None
+_driver_pool_lock = threading.Lock()
+
+
+def driver_pool() -> DriverPool:
+    """Get the drivers pool shared by all the readings, creating it on first use."""
+    global _driver_pool
+    with _driver_pool_lock:
+        if _driver_pool is None:
+            cfg = get_config()["browser"]
+            _driver_pool = DriverPool(
+                browser_setup,
+                size=cfg.get("pool_size", 4),
+                max_uses=cfg.get("max_uses", 20),
+            )
+        return _driver_pool
+
+
+@atexit.register
+def close_driver_pool():
+    """Quit all the idle drivers. A new pool is created on the next reading."""
+    global _driver_pool
+    with _driver_pool_lock:
+        if _driver_pool is not None:
+            _driver_pool.close()
+            _driver_pool = None
+
+
+_concurrency = None
+
+
+def concurrency_controller() -> ConcurrencyController:
+    """Get the controller of the concurrent readings, its state lasts between cycles."""
+    global _concurrency
+    if _concurrency is None:
+        config = get_config()
+        cfg = config.get("adaptive", {})
+        max_workers = cfg.get("max", 8)
+        if config["script"].get("reader", "selenium") == "selenium":
+            # more readers than browsers would only wait for one
+            max_workers = min(max_workers, config["browser"].get("pool_size", 4))
+        _concurrency = ConcurrencyController(
+            current=config["script"].get("concurrency", 4),
+            min_workers=cfg.get("min", 1),
+            max_workers=max_workers,
+            target_latency=cfg.get("target_latency", 60),
+            max_error_rate=cfg.get("max_error_rate", 0.2),
+            reader_mb=cfg.get("reader_mb", 300),
+            reserve_mb=cfg.get("reserve_mb", 200),
+        )
+    return _concurrency
+
+
+_breaker = None
+
+
+def circuit_breaker() -> CircuitBreaker:
+    """Get the circuit breaker of the portal, None when disabled in the config."""
+    global _breaker
+    cfg = get_config().get("breaker", {})
+    if not cfg.get("enabled", False):
+        return None
+    if _breaker is None:
+        _breaker = CircuitBreaker(
+            window=cfg.get("window", 10),
+            min_calls=cfg.get("min_calls", 5),
+            failure_rate=cfg.get("failure_rate", 0.5),
+            cooldown=cfg.get("cooldown", 60),
+            max_cooldown=cfg.get("max_cooldown", 600),
+        )
+    return _breaker
+
+
+_planner = None
+
+
+def cycle_planner() -> "cycles.CyclePlanner":
+    """Get the planner of the reading cycles, it keeps the users carried over."""
+    global _planner
+    cfg = get_config()["script"]
+    if _planner is None or _planner.interval != cfg["frecuencia [minutos]"]:
+        _planner = cycles.CyclePlanner(
+            cfg["frecuencia [minutos]"],
+            auto=cfg.get("auto_interval", False),
+            headroom=cfg.get("interval_headroom", 1.2),
+        )
+    return _planner
+
+
 def save_results(results):
-    """Save data after reading cycle."""
-    data: dict = storage("results")
-    updated = defaultdict(list)
-    updated.update(data)
-    for res in results:
-        succeed, values = res
-        if succeed:
-            for k, v in values.items():
-                updated[k].append(v.to_tuple(True))  # TODO: Must be tested
-        else:
-            # TODO: Add trace of failed readings
-            # failed.append(data)
-            pass
-    with open(f"{base_path}/results.json", "w") as f:
-        json.dump(updated, f)
+    """Append the readings of a cycle to the results log."""
+    for succeed, values in results:
+        if not succeed:
+            # already retried during the cycle, there is no value to save
+            info_log.error(f"{list(values)} Sin lectura en este ciclo")
+    results_log.results_log().append(results)
 
 
 #########################
@@ -156,7 +311,24 @@ class ReadConsumption:
     username: str = None
     password: str = None
     driver: webdriver = None
-    # cfg: dict = get_config() TODO: Add config info to obj
+    cfg: dict = field(default_factory=lambda: get_config()["browser"])
+    timings: ReadTimings = None
+
+    def __post_init__(self):
+        if self.timings is None:
+            self.timings = ReadTimings(self.username)
+
+    def wait(self) -> WebDriverWait:
+        """Explicit wait, checks every `poll_interval` until the phase `timeout`."""
+        return WebDriverWait(
+            self.driver,
+            self.cfg["timeout"],
+            poll_frequency=self.cfg.get("poll_interval", 0.25),
+        )
+
+    def find(self, by: str, value: str):
+        """Wait for an element to be present on the page."""
+        return self.wait().until(EC.presence_of_element_located((by, value)))
 
     def login(self):
         """Deal with user login."""
@@ -164,33 +336,92 @@ class ReadConsumption:
         if not all([self.username, self.password]):
             self.username = input("Usuario: ")
             self.password = input("Contraseña: ")
-        user_in = self.driver.find_element_by_name("username")
+        user_in = self.find(By.NAME, "username")
         user_in.send_keys(self.username)
-        password_in = self.driver.find_element_by_name("password")
+        password_in = self.find(By.NAME, "password")
         password_in.send_keys(self.password)
-        submit = self.driver.find_element_by_css_selector(".slds-button_brand")
-        submit.click()
+        self.wait_to_be_clickable(".slds-button_brand")
         info_log.info(f"[{self.username}] Usuari@ logged")
 
+    def record_page_load(self):
+        """Keep the load time of the current page, to compare browser configurations."""
+        duration = self.driver.execute_script(
+            "const nav = performance.getEntriesByType('navigation')[0];"
+            "return nav ? nav.duration : null;"
+        )
+        if duration:
+            self.timings.gauges["page_load"] = duration / 1000
+
     def contador_online(self):
         """Navigate into consume area."""
         btn_selector = (
             "li.slds-col:nth-child(8) > span:nth-child(1) > button:nth-child(1)"
         )
         # btn_selector = "div.slds-col:nth-child(8) > div:nth-child(1) > div:nth-child(1)"  # old
-        btn = self.driver.find_element_by_css_selector(btn_selector)
-        btn.click()
+        self.wait_to_be_clickable(btn_selector)
         info_log.info(f"[{self.username}] Area Contador Online")
-        self.driver.find_element_by_name("ActionReconectar").click()
+        self.wait_to_be_clickable("[name='ActionReconectar']")
 
-    def get_actual_consume(self, page: str) -> Tuple[bool, Dict[str, SingleReadData]]:
-        """Extract values from page source after getting readings values."""
+    def resume_session(self) -> bool:
+        """Restore the user session saved on a previous cycle and go to consume area.
+
+        Returns False when there isn't a session or it has expired, meaning that a new
+        login is needed.
+        """
+        session = sessions.load(self.username)
+        if session is None:
+            return False
+        # cookies can only be set for the domain currently loaded
+        self.driver.get(LOGIN_URL)
+        for cookie in session["cookies"]:
+            self.driver.add_cookie(cookie)
+        self.driver.execute_script(
+            "for (const [k, v] of Object.entries(arguments[0])) localStorage.setItem(k, v);",
+            session["local_storage"],
+        )
+        self.driver.get(HOME_URL)
+        try:
+            if "/login" in self.driver.current_url:
+                raise NoSuchElementException("Redirected to login page")
+            self.contador_online()
+        except (NoSuchElementException, TimeoutException):
+            info_log.info(f"[{self.username}] Sesión caducada")
+            sessions.forget(self.username)
+            return False
+        info_log.info(f"[{self.username}] Sesión restaurada")
+        return True
+
+    def keep_session(self):
+        """Save the user session to be used on the next cycle."""
+        sessions.save(
+            self.username,
+            self.driver.get_cookies(),
+            self.driver.execute_script("return Object.assign({}, window.localStorage);"),
+        )
+
+    def read_values(self) -> Tuple[float, float, float]:
+        """Get the values from the live DOM in a single round trip."""
+        try:
+            texts = self.driver.execute_script(EXTRACT_JS)
+        except WebDriverException:
+            return parse_values(self.driver.page_source)
+        if None in texts:
+            raise IndexError("Values not found on page")
+        return _actual_read(texts[0]), _relative_percent(texts[1]), _max_power(texts[2])
+
+    def get_actual_consume(
+        self, page: str = None
+    ) -> Tuple[bool, Dict[str, SingleReadData]]:
+        """Extract values after getting readings values.
+
+        From the live DOM, or from `page` source when it's given.
+        """
         date = datetime.datetime.now()
         try:
-            soup = bs4.BeautifulSoup(page, features="html.parser")
-            actual_read = _actual_read(soup.select(".description")[0].text)
-            percent = _relative_percent(soup.select(".percent")[0].text)
-            max_power = _max_power(soup.select(".max > span:nth-child(1)")[0].text)
+            if page is None:
+                actual_read, percent, max_power = self.read_values()
+            else:
+                actual_read, percent, max_power = parse_values(page)
 
             return (
                 True,
@@ -198,120 +429,215 @@ class ReadConsumption:
                 # {self.username: (date, actual_read, percent, max_power)},
             )
         except IndexError:
-            # It means that was not possible to get information from page
-            # TODO: reschedule task
+            # It means that was not possible to get information from page, the
+            # reading is retried later in the cycle (see orchestrator.Cycle)
             return (
                 False,
                 {self.username: SingleReadData(date, None, None, None)},
             )
 
     def wait_to_be_clickable(self, selector):
-        """Deal with object present on DOM but not be clickable because spinning gif."""
-        retries = 0
-        while retries < 5:
+        """Deal with object present on DOM but not be clickable because spinning gif.
+
+        The click is tried on every poll until it isn't intercepted anymore.
+        """
+
+        def click(driver):
             try:
-                btn = self.driver.find_element_by_css_selector(selector)
-                btn.click()
-                break
-            except ElementClickInterceptedException:
-                time.sleep(0.5)
-                retries += 1
-        return
+                driver.find_element_by_css_selector(selector).click()
+                return True
+            except (
+                ElementClickInterceptedException,
+                ElementNotInteractableException,
+                NoSuchElementException,
+            ):
+                return False
+
+        self.wait().until(click)
 
     def _read_succeed(self):
-        """Ensure that "consulta contador" succeed."""
-        status = False
-        self.driver.implicitly_wait(3)
+        """Ensure that "consulta contador" succeed.
+
+        Waits until the consumption values or the error popup show up, whatever comes
+        first, while the spinner gif is still present.
+        """
+
+        def outcome(driver):
+            if driver.find_elements_by_css_selector(".percent"):
+                return True
+            errors = driver.find_elements_by_css_selector("[title='ENTENDIDO']")
+            return errors[0] if errors else False
 
         try:
-            self.driver.find_element_by_css_selector(".percent")
-            status = True  # Succeed
-        except NoSuchElementException:
-            # means that consumption value isn't visible
-            try:
-                # Checks if there was a error
-                error = self.driver.find_element_by_css_selector("[title='ENTENDIDO']")
-                error.click()
-                info_log.error(f"[{self.username}] Solicitud fallada [Error Popup]")
-            except NoSuchElementException:
-                # Probably is still present the spinner gif we run it again
-                info_log.info(
-                    f"\x1b[80D\x1b[1A\x1b[K[{self.username}] Todavía procesando"
-                )
-                self._read_succeed()
-        return status
-
-    def lectura(self, retry=True):
+            result = self.wait().until(outcome)
+        except TimeoutException:
+            info_log.error(f"[{self.username}] Solicitud fallada [Tiempo agotado]")
+            return False
+        if result is True:
+            return True
+        result.click()  # close the error popup
+        info_log.error(f"[{self.username}] Solicitud fallada [Error Popup]")
+        return False
+
+    def lectura(self):
         """Request the actual reading to the service.
 
-        If it fails, it will automatically retry one try.
-        TODO: Add a reschedule if it fails twice
+        Failed readings aren't retried here, holding the browser, but rescheduled in the
+        cycle retry queue.
         """
         info_log.info(f"[{self.username}] Solicitando los valores de lectura ...")
         self.wait_to_be_clickable("[title='Consultar Contador']")
-        while True:
-            # time.sleep(1)
-            if self._read_succeed():
-                info_log.info(f"[{self.username}] Solicitud aceptada")
-                status = True
-                break
-            else:
-                # info_log.error(f"[{self.username}] Solicitud fallada")
-                if retry:
-                    info_log.info(f"[{self.username}] Reintentando ...")
-                    self.lectura(retry=False)
-                status = False
-                info_log.info(f"[{self.username}] No ha sido posible hacer la lectura")
-                break
-        # self.driver.implicitly_wait(30)  # TODO: Get it from cfg info
-        return status
+        if self._read_succeed():
+            info_log.info(f"[{self.username}] Solicitud aceptada")
+            return True
+        info_log.info(f"[{self.username}] No ha sido posible hacer la lectura")
+        return False
 
     def get_reading(self):
-        """Start reading."""
-        self.driver.get(
-            "https://zonaprivada.edistribucion.com/areaprivada/s/login/?language=es"
-        )
-        # log in form
-        self.login()
-        self.contador_online()
-        self.lectura()
-        succeed, values = self.get_actual_consume(self.driver.page_source)
-        self.driver.close()
+        """Start reading.
+
+        Login is only done when there isn't a valid session from a previous cycle.
+        """
+        keep_sessions = self.cfg.get("keep_sessions", True) and self.username
+        with self.timings.phase("session"):
+            resumed = keep_sessions and self.resume_session()
+        if not resumed:
+            with self.timings.phase("login"):
+                self.driver.get(LOGIN_URL)
+                self.record_page_load()
+                # log in form
+                self.login()
+            with self.timings.phase("contador_online"):
+                self.contador_online()
+        with self.timings.phase("lectura"):
+            self.lectura()
+        if keep_sessions:
+            with self.timings.phase("session"):
+                self.keep_session()
+        with self.timings.phase("parse"):
+            succeed, values = self.get_actual_consume()
+        self.timings.outcome = "ok" if succeed else "failed"
+        values[self.username].timings = self.timings
         return succeed, values
 
 
 def read():
     """Single thread script entrypoint."""
     users = storage("users")["usuarios"]
-    save_results(
-        [
-            ReadConsumption(
-                username=user["username"],
-                password=user["password"],
-                driver=browser_setup(),
-            ).get_reading()
-            for user in users
-        ]
-    )
+    results = [_multiple(user) for user in users]
+    save_results(results)
+    metrics.record(results)
     print("#" * 20)
 
 
+def _selenium_reading(user):
+    timings = ReadTimings(user["username"])
+    pool = driver_pool()
+    with timings.phase("browser"):
+        driver = pool.acquire()
+    try:
+        return ReadConsumption(
+            username=user["username"],
+            password=user["password"],
+            driver=driver,
+            timings=timings,
+        ).get_reading()
+    finally:
+        try:
+            rss = metrics.process_tree_rss_mb(driver.service.process.pid)
+            if rss is not None:
+                timings.gauges["rss_mb"] = rss
+        finally:
+            pool.release(driver)
+
+
+def _http_reading(user):
+    return http_reader.read_user(user)
+
+
+# Reader backends selectable with `"reader"` in the script config. All of them take a
+# user dict and return the same (succeed, {dni: SingleReadData}) tuple.
+READERS = {"selenium": _selenium_reading, "http": _http_reading}
+
+
+def get_reader():
+    """Reader backend set in the config file."""
+    return READERS[get_config()["script"].get("reader", "selenium")]
+
+
 def _multiple(user):
-    return ReadConsumption(
-        username=user["username"], password=user["password"], driver=browser_setup(),
-    ).get_reading()
+    return get_reader()(user)
 
 
-def read_multiple(pool, users=None, save=True):
-    """Threadpool script entrypoint."""
+def read_multiple(users=None, save=True, cycle=True, on_result=None):
+    """Concurrent script entrypoint.
+
+    A scheduled `cycle` spreads the users over the `"stagger"` fraction of the interval,
+    starts with the users carried over from the previous one and is recorded in the
+    metrics. Otherwise (a batch of the work queue) all the users are read straight away.
+
+    Every result is saved, and given to `on_result`, as soon as its reading is done, from
+    a single writer thread.
+    """
+
+    def write(result):
+        if save:
+            save_results([result])
+        if on_result is not None:
+            on_result(result)
+
     if not users:
         users = storage("users")["usuarios"]
-    results = pool.map(_multiple, users)
-    if save:
-        save_results(results)
+    cfg = get_config()["script"]
+    planner = cycle_planner()
+    interval = planner.effective * 60
+    timeout = cfg.get("user_timeout", 300)
+    margin = cfg.get("cycle_margin", 15)
+    deadline = orchestrator.cycle_deadline(interval, margin)
+    stagger = orchestrator.stagger_window(
+        interval, cfg.get("stagger", 0.8), timeout, margin
+    )
+    priority: list = []
+    if cycle:
+        users, priority = planner.users(users)
+    concurrency = cfg.get("concurrency", 4)
+    adaptive = get_config().get("adaptive", {}).get("enabled", False)
+    if adaptive:
+        idle = _driver_pool.idle if _driver_pool is not None else 0
+        concurrency = concurrency_controller().next(idle)
+        info_log.info(f"{concurrency} lecturas simultaneas")
+    started = datetime.datetime.now()
+    with orchestrator.ResultWriter(write) as writer:
+        results = orchestrator.run_cycle(
+            users,
+            get_reader(),
+            concurrency=concurrency,
+            timeout=timeout,
+            retries=cfg.get("retries", 2),
+            backoff=cfg.get("retry_backoff", 5),
+            deadline=deadline,
+            stagger=stagger if cycle else 0,
+            breaker=circuit_breaker(),
+            delay=get_config().get("breaker", {}).get("delay", True),
+            priority=priority,
+            on_result=writer.put,
+        )
+    if adaptive:
+        concurrency_controller().update(results)
+    if cycle:
+        report = planner.finish(users, results, started, concurrency)
+        if report.cause:
+            info_log.error(
+                f"Ciclo de {report.seconds}s, {report.carried} usuarios pasan al "
+                f"siguiente ({report.cause})"
+            )
+        metrics.record_cycle(report)
+    metrics.record(results)
     print("#" * 20)
     return results
 
 
+from scrapper import cycles, http_reader, orchestrator, results_log  # noqa isort:skip
+
 if __name__ == "__main__":
     read()  # for testing
@@ -0,0 +1,140 @@
+"""Reading cycles that don't fit in their interval.
+
+A cycle has until the next one to read every user. Users that couldn't even start by then
+are carried over to the next cycle, where they go first, and the overrun is recorded with
+its most likely cause. With `"auto_interval"` the interval is lengthened while the users
+don't fit in it, and shortened back once they do.
+"""
+
+import datetime
+import math
+import threading
+from dataclasses import dataclass, field
+from typing import List, Tuple
+
+from apscheduler.events import (  # type: ignore
+    EVENT_JOB_EXECUTED,
+    EVENT_JOB_MAX_INSTANCES,
+    EVENT_JOB_MISSED,
+)
+
+from scrapper import metrics
+from scrapper.orchestrator import CARRIED, interval_start, outcome
+
+
+@dataclass
+class CycleReport:
+    started: datetime.datetime
+    seconds: float
+    interval: float
+    users: int
+    failed: int
+    carried: int
+    cause: str = None
+
+
+@dataclass
+class CyclePlanner:
+    """Order of the users and interval of every cycle.
+
+    `interval` is the configured one, in minutes, `headroom` the extra time left when it's
+    lengthened.
+    """
+
+    interval: float
+    auto: bool = False
+    headroom: float = 1.2
+    effective: float = None
+    _carried: List[dict] = field(default_factory=list, init=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock, init=False)
+
+    def __post_init__(self):
+        self.effective = self.effective or self.interval
+
+    def users(self, users: List[dict]) -> Tuple[List[dict], List[str]]:
+        """Users of the next cycle, the carried over first, and the DNIs of these."""
+        with self._lock:
+            carried, self._carried = self._carried, []
+        dnis = [user["username"] for user in carried]
+        return carried + [u for u in users if u["username"] not in dnis], dnis
+
+    def finish(
+        self,
+        users: List[dict],
+        results: List,
+        started: datetime.datetime,
+        concurrency: int,
+    ) -> CycleReport:
+        """Carry over the users not started and adjust the interval to the workload."""
+        seconds = (datetime.datetime.now() - started).total_seconds()
+        timings = [
+            read.timings
+            for _, values in results
+            for read in values.values()
+            if getattr(read, "timings", None) is not None
+        ]
+        carried = [
+            user
+            for user, (_, values) in zip(users, results)
+            if outcome(values[user["username"]]) == CARRIED
+        ]
+        with self._lock:
+            self._carried = carried
+        report = CycleReport(
+            started=started,
+            seconds=round(seconds, 1),
+            interval=self.effective,
+            users=len(users),
+            failed=sum(1 for succeed, _ in results if not succeed),
+            carried=len(carried),
+        )
+        # time the readings would take back to back, at the cycle concurrency
+        busy = sum(t.total for t in timings) / max(concurrency, 1)
+        if carried or seconds > self.effective * 60:
+            report.cause = overrun_cause(timings, busy, self.effective * 60)
+        if self.auto:
+            needed = math.ceil(busy * self.headroom / 60)
+            self.effective = max(self.interval, needed)
+        return report
+
+
+def overrun_cause(timings: list, busy: float, interval: float) -> str:
+    """Most likely reason for a cycle to overrun its interval."""
+    outcomes = [t.outcome for t in timings]
+    if "skipped" in outcomes:
+        return "portal_down"
+    if busy > interval:
+        return "too_many_users"
+    if "timeout" in outcomes:
+        return "slow_readings"
+    return "retries"
+
+
+def watch(scheduler, job_id: str, planner_fn):
+    """Record the cycles the scheduler had to drop, and follow the interval changes of
+    the planner returned by `planner_fn`."""
+
+    def listener(event):
+        if event.job_id != job_id:
+            return
+        if event.code == EVENT_JOB_EXECUTED:
+            minutes = planner_fn().effective
+            job = scheduler.get_job(job_id)
+            if job is not None and job.trigger.interval.total_seconds() != minutes * 60:
+                scheduler.reschedule_job(
+                    job_id,
+                    trigger="interval",
+                    minutes=minutes,
+                    start_date=interval_start(minutes),
+                )
+            return
+        # the previous cycle is still running (max instances) or the scheduler was late
+        cause = "overlap" if event.code == EVENT_JOB_MAX_INSTANCES else "missed"
+        now = datetime.datetime.now()
+        metrics.record_cycle(
+            CycleReport(now, 0, planner_fn().effective, 0, 0, 0, cause)
+        )
+
+    scheduler.add_listener(
+        listener, EVENT_JOB_EXECUTED | EVENT_JOB_MAX_INSTANCES | EVENT_JOB_MISSED
+    )
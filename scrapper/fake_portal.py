@@ -0,0 +1,233 @@
+"""Local stand-in of the e-distribución portal.
+
+Mimics the login and "consultar contador" responses of the portal Aura endpoints, so the
+http reader can be tested and benchmarked offline.
+
+Usage:
+    python -m scrapper.fake_portal [port]         # serve until Ctrl+C
+    python -m scrapper.fake_portal bench [reads]  # benchmark the http reader
+"""
+
+import json
+import random
+import secrets
+import sys
+import threading
+import time
+from dataclasses import dataclass, field
+from http.cookies import SimpleCookie
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict
+from urllib.parse import parse_qs, urlparse
+
+PREFIX = "/areaprivada"
+FWUID = "fake-fwuid"
+
+LOGIN_PAGE = (
+    "<html><body><script>"
+    f'window.auraConfig = {{"context": {{"fwuid":"{FWUID}"}}}};'
+    "</script>"
+    '<input name="username"><input name="password" type="password">'
+    "</body></html>"
+)
+HOME_PAGE = (
+    '<html><body><script>window.auraConfig = {{"token":"{token}"}};</script>'
+    "</body></html>"
+)
+
+
+@dataclass
+class FakePortal:
+    """Threaded http server answering as the portal would.
+
+    Any password is accepted unless the user is in `users`. `error_rate` is the chance of
+    a reading failing as it does with the "ENTENDIDO" popup.
+    """
+
+    port: int = 0
+    users: Dict[str, str] = field(default_factory=dict)
+    error_rate: float = 0.0
+    latency: float = 0.0
+    logins: int = 0
+    _sessions: Dict[str, str] = field(default_factory=dict)
+
+    def __post_init__(self):
+        portal = self
+
+        class Handler(_Handler):
+            pass
+
+        Handler.portal = portal
+        self.server = ThreadingHTTPServer(("127.0.0.1", self.port), Handler)
+        self.port = self.server.server_address[1]
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}{PREFIX}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def expire_sessions(self):
+        self._sessions.clear()
+
+    def login(self, username: str, password: str) -> str:
+        if username in self.users and self.users[username] != password:
+            return None
+        sid = secrets.token_hex(16)
+        self._sessions[sid] = username
+        self.logins += 1
+        return sid
+
+    def reading(self) -> dict:
+        if random.random() < self.error_rate:
+            return {"success": False, "message": "Error al consultar el contador"}
+        max_power = random.choice([3.3, 4.4, 5.7])
+        power = round(random.uniform(0, max_power), 2)
+        percent = f"{power / max_power * 100:.2f}".replace(".", ",") + "%"
+        return {
+            "success": True,
+            "data": {
+                "potenciaActual": str(power).replace(".", ","),
+                "potenciaContratada": str(max_power).replace(".", ","),
+                "percent": percent,
+            },
+        }
+
+
+class _Handler(BaseHTTPRequestHandler):
+    portal: FakePortal
+
+    def log_message(self, format, *args):
+        pass  # keep tests and benchmark output clean
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == f"{PREFIX}/s/login/":
+            self._send(200, LOGIN_PAGE, "text/html")
+        elif url.path == f"{PREFIX}/secur/frontdoor.jsp":
+            sid = parse_qs(url.query).get("sid", [""])[0]
+            self._send(
+                302,
+                "",
+                headers={
+                    "Location": f"{PREFIX}/s/",
+                    "Set-Cookie": f"sid={sid}; Path=/",
+                },
+            )
+        elif url.path == f"{PREFIX}/s/":
+            if self._user() is None:
+                self._send(302, "", headers={"Location": f"{PREFIX}/s/login/"})
+            else:
+                self._send(200, HOME_PAGE.format(token=self._sid()), "text/html")
+        else:
+            self._send(404, "")
+
+    def do_POST(self):
+        if urlparse(self.path).path != f"{PREFIX}/s/sfsites/aura":
+            return self._send(404, "")
+        time.sleep(self.portal.latency)
+        length = int(self.headers.get("Content-Length", 0))
+        form = parse_qs(self.rfile.read(length).decode())
+        action = json.loads(form["message"][0])["actions"][0]
+        descriptor = action["descriptor"].split("//")[-1]
+        params = action["params"]
+        if descriptor == "LightningLoginFormController/ACTION$login":
+            sid = self.portal.login(params["username"], params["password"])
+            if sid is None:
+                return self._action(action, error="Usuario o contraseña incorrectos")
+            frontdoor = f"{PREFIX}/secur/frontdoor.jsp?sid={sid}"
+            return self._json(
+                {"events": [{"attributes": {"values": {"url": frontdoor}}}]}
+            )
+        if self._user() is None or form.get("aura.token", [""])[0] != self._sid():
+            return self._json(
+                {
+                    "exceptionEvent": True,
+                    "event": {"descriptor": "markup://aura:invalidSession"},
+                }
+            )
+        if descriptor == "WP_ContadorICP_F2_CTRL/ACTION$getCUPSReconectarICP":
+            self._action(
+                action, {"data": {"lstCups": [{"Id": "a0F1", "Name": "ES0031"}]}}
+            )
+        elif descriptor == "WP_ContadorICP_F2_CTRL/ACTION$consultarContador":
+            self._action(action, self.portal.reading())
+        else:
+            self._send(404, "")
+
+    def _sid(self) -> str:
+        cookie = SimpleCookie(self.headers.get("Cookie", ""))
+        return cookie["sid"].value if "sid" in cookie else ""
+
+    def _user(self):
+        return self.portal._sessions.get(self._sid())
+
+    def _action(self, action: dict, value: dict = None, error: str = None):
+        state = "ERROR" if error else "SUCCESS"
+        self._json(
+            {
+                "actions": [
+                    {
+                        "id": action["id"],
+                        "state": state,
+                        "returnValue": value,
+                        "error": [{"message": error}] if error else [],
+                    }
+                ]
+            }
+        )
+
+    def _json(self, data: dict):
+        self._send(200, json.dumps(data), "application/json")
+
+    def _send(
+        self, status: int, body: str, content_type: str = None, headers: dict = None
+    ):
+        payload = body.encode()
+        self.send_response(status)
+        if content_type:
+            self.send_header("Content-Type", f"{content_type}; charset=utf-8")
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def bench(reads: int = 200, workers: int = 8):
+    """Readings per second of the http reader against the fake portal."""
+    from multiprocessing.pool import ThreadPool
+
+    from scrapper.http_reader import HttpReadConsumption
+
+    portal = FakePortal(latency=0.05).start()
+    users = [f"{n:08d}A" for n in range(reads)]
+
+    def _read(dni):
+        return HttpReadConsumption(dni, "pass", base_url=portal.url).get_reading()
+
+    start = time.perf_counter()
+    with ThreadPool(workers) as pool:
+        results = pool.map(_read, users)
+    elapsed = time.perf_counter() - start
+    portal.stop()
+    ok = sum(1 for succeed, _ in results if succeed)
+    print(
+        f"{reads} lecturas ({ok} correctas) en {elapsed:.2f}s: {reads / elapsed:.1f}/s"
+    )
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["bench"]:
+        bench(*map(int, sys.argv[2:3]))
+    else:
+        port = int(sys.argv[1]) if len(sys.argv) > 1 else 8088
+        portal = FakePortal(port=port)
+        print(f"Fake portal: {portal.url}")
+        portal.server.serve_forever()
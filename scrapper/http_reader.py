@@ -0,0 +1,252 @@
+"""Browser-free reader talking directly to the portal Aura endpoints."""
+
+import datetime
+import itertools
+import json
+import re
+import threading
+from dataclasses import dataclass
+from typing import Dict, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from scrapper.contador import (
+    SingleReadData,
+    _relative_percent,
+    _to_float,
+    get_config,
+    info_log,
+    sessions,
+)
+from scrapper.metrics import ReadTimings
+from scrapper.sessions import SessionStore
+
+BASE_URL = "https://zonaprivada.edistribucion.com/areaprivada"
+LOGIN = "apex://LightningLoginFormController/ACTION$login"
+CUPS = "apex://WP_ContadorICP_F2_CTRL/ACTION$getCUPSReconectarICP"
+CONSULTAR = "apex://WP_ContadorICP_F2_CTRL/ACTION$consultarContador"
+
+FWUID_RE = re.compile(r'"fwuid":"([^"]+)"')
+TOKEN_RE = re.compile(r'"token":"([^"]+)"')
+
+_request_id = itertools.count(1)
+
+
+class SessionExpired(Exception):
+    """The portal rejected the session, a new login is needed."""
+
+
+_adapter = None
+_adapter_lock = threading.Lock()
+
+
+def http_adapter() -> HTTPAdapter:
+    """Connection pool shared by all the users sessions."""
+    global _adapter
+    with _adapter_lock:
+        if _adapter is None:
+            cfg = get_config().get("http", {})
+            size = cfg.get("pool_maxsize", 10)
+            _adapter = HTTPAdapter(pool_connections=2, pool_maxsize=size)
+        return _adapter
+
+
+def new_session() -> requests.Session:
+    """Session with its own cookies but using the shared connection pool.
+
+    Don't call `close()` on it, that would also close the shared pool.
+    """
+    session = requests.Session()
+    adapter = http_adapter()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+@dataclass
+class HttpReadConsumption:
+    """Request power consumption for each user without a browser.
+
+    Same flow than `ReadConsumption`: login, look up the contract (CUPS) and ask the meter
+    for the actual reading.
+    """
+
+    username: str = None
+    password: str = None
+    base_url: str = BASE_URL
+    timeout: float = 30
+    session: requests.Session = None
+    sessions: SessionStore = None
+    token: str = "undefined"
+    fwuid: str = ""
+    timings: ReadTimings = None
+
+    def __post_init__(self):
+        if self.session is None:
+            self.session = new_session()
+        if self.timings is None:
+            self.timings = ReadTimings(self.username)
+
+    def action(self, descriptor: str, params: dict, page_uri: str = "/areaprivada/s/"):
+        """Call an Aura controller action and return its value."""
+        message = {
+            "actions": [
+                {
+                    "id": f"{next(_request_id)};a",
+                    "descriptor": descriptor,
+                    "params": params,
+                }
+            ]
+        }
+        context = {"mode": "PROD", "fwuid": self.fwuid, "app": "siteforce:communityApp"}
+        resp = self.session.post(
+            f"{self.base_url}/s/sfsites/aura",
+            params={"r": next(_request_id)},
+            data={
+                "message": json.dumps(message),
+                "aura.context": json.dumps(context),
+                "aura.pageURI": page_uri,
+                "aura.token": self.token,
+            },
+            timeout=self.timeout,
+        )
+        resp.raise_for_status()
+        data = json.loads(resp.text.replace("while(1);", "", 1))
+        if data.get("exceptionEvent"):
+            raise SessionExpired(data["event"]["descriptor"])
+        return data
+
+    @staticmethod
+    def _return_value(data: dict) -> dict:
+        action = data["actions"][0]
+        if action["state"] != "SUCCESS":
+            raise ValueError(action["error"])
+        return action["returnValue"]
+
+    def login(self):
+        """Authenticate and get the session token."""
+        info_log.info(f"[{self.username}] Login (http)")
+        page = self.session.get(f"{self.base_url}/s/login/", timeout=self.timeout)
+        match = FWUID_RE.search(page.text)
+        self.fwuid = match.group(1) if match else ""
+        data = self.action(
+            LOGIN,
+            {
+                "username": self.username,
+                "password": self.password,
+                "startUrl": "/areaprivada/s/",
+            },
+            page_uri="/areaprivada/s/login/?language=es",
+        )
+        if "events" not in data:
+            self._return_value(data)  # raises with the portal error message
+        frontdoor = data["events"][0]["attributes"]["values"]["url"]
+        # frontdoor sets the session cookies and redirects to the private area
+        home = self.session.get(
+            requests.compat.urljoin(self.base_url, frontdoor), timeout=self.timeout
+        )
+        match = TOKEN_RE.search(home.text)
+        if match is None:
+            raise ValueError("Login fallado, no hay token de sesión")
+        self.token = match.group(1)
+
+    def resume_session(self) -> bool:
+        """Reuse the session stored on a previous cycle."""
+        session = self.sessions.load(self.username) if self.sessions else None
+        if session is None:
+            return False
+        for cookie in session["cookies"]:
+            self.session.cookies.set(
+                cookie["name"],
+                cookie["value"],
+                domain=cookie.get("domain", ""),
+                path=cookie.get("path", "/"),
+            )
+        self.token = session["local_storage"].get("aura.token", "undefined")
+        self.fwuid = session["local_storage"].get("fwuid", "")
+        return True
+
+    def keep_session(self):
+        if self.sessions is None:
+            return
+        cookies = [
+            {
+                "name": c.name,
+                "value": c.value,
+                "domain": c.domain,
+                "path": c.path,
+                "secure": c.secure,
+                "expiry": c.expires,
+            }
+            for c in self.session.cookies
+        ]
+        self.sessions.save(
+            self.username, cookies, {"aura.token": self.token, "fwuid": self.fwuid}
+        )
+
+    def cups(self) -> str:
+        """Id of the user contract."""
+        value = self._return_value(self.action(CUPS, {}))
+        return value["data"]["lstCups"][0]["Id"]
+
+    def consultar_contador(self, cups: str) -> dict:
+        value = self._return_value(self.action(CONSULTAR, {"atrId": cups}))
+        if not value.get("success"):
+            raise ValueError(value.get("message"))
+        return value["data"]
+
+    def get_reading(self) -> Tuple[bool, Dict[str, SingleReadData]]:
+        """Start reading. Same output than `ReadConsumption.get_reading`."""
+        date = datetime.datetime.now()
+        timings = self.timings
+        try:
+            with timings.phase("session"):
+                resumed = self.resume_session()
+            if not resumed:
+                with timings.phase("login"):
+                    self.login()
+            try:
+                with timings.phase("contador_online"):
+                    cups = self.cups()
+            except SessionExpired:
+                info_log.info(f"[{self.username}] Sesión caducada")
+                if self.sessions:
+                    self.sessions.forget(self.username)
+                self.session.cookies.clear()
+                with timings.phase("login"):
+                    self.login()
+                with timings.phase("contador_online"):
+                    cups = self.cups()
+            with timings.phase("lectura"):
+                data = self.consultar_contador(cups)
+            with timings.phase("session"):
+                self.keep_session()
+            with timings.phase("parse"):
+                read = SingleReadData(
+                    date,
+                    _to_float(str(data["potenciaActual"])),
+                    _relative_percent(str(data["percent"])),
+                    _to_float(str(data["potenciaContratada"])),
+                    timings=timings,
+                )
+            timings.outcome = "ok"
+            return (True, {self.username: read})
+        except (requests.RequestException, SessionExpired, KeyError, ValueError) as e:
+            info_log.error(f"[{self.username}] Solicitud fallada {e!r}")
+            timings.outcome = "failed"
+            read = SingleReadData(date, None, None, None, timings=timings)
+            return (False, {self.username: read})
+
+
+def read_user(user: dict):
+    """Reader entrypoint used by `contador` when `"reader": "http"` is configured."""
+    cfg = get_config()
+    http_cfg = cfg.get("http", {})
+    return HttpReadConsumption(
+        username=user["username"],
+        password=user["password"],
+        base_url=http_cfg.get("base_url", BASE_URL),
+        timeout=http_cfg.get("timeout", cfg["browser"]["timeout"]),
+        sessions=sessions if cfg["browser"].get("keep_sessions", True) else None,
+    ).get_reading()
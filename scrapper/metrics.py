@@ -0,0 +1,249 @@
+"""Per phase latency of the readings.
+
+Usage:
+    python -m scrapper.metrics  # p50/p95 per phase and per user
+"""
+
+import datetime
+import os
+import sqlite3
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Iterable, List
+
+DB_PATH = Path(__file__).parent / "metrics.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS timings (
+    dni TEXT NOT NULL,
+    started TIMESTAMP NOT NULL,
+    outcome TEXT NOT NULL,
+    phase TEXT NOT NULL,
+    seconds REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_timings_started ON timings (started);
+CREATE TABLE IF NOT EXISTS gauges (
+    dni TEXT NOT NULL,
+    started TIMESTAMP NOT NULL,
+    outcome TEXT NOT NULL,
+    gauge TEXT NOT NULL,
+    value REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_gauges_started ON gauges (started);
+CREATE TABLE IF NOT EXISTS cycles (
+    started TIMESTAMP NOT NULL,
+    seconds REAL NOT NULL,
+    interval REAL NOT NULL,
+    users INTEGER NOT NULL,
+    failed INTEGER NOT NULL,
+    carried INTEGER NOT NULL,
+    cause TEXT
+);
+"""
+
+
+@dataclass
+class ReadTimings:
+    """Seconds spent on every phase of a reading and how it ended.
+
+    `gauges` are other measures taken during the reading, like the page load time or
+    the browser memory, not part of the total. `retried` are the timings of the failed
+    attempts of the same reading before this one.
+
+    An exception raised inside a phase ends the reading as `"error"` and takes these
+    timings with it, in its `timings` attribute.
+    """
+
+    username: str
+    outcome: str = "pending"
+    phases: Dict[str, float] = field(default_factory=dict)
+    gauges: Dict[str, float] = field(default_factory=dict)
+    started: datetime.datetime = field(default_factory=datetime.datetime.now)
+    retried: List["ReadTimings"] = field(default_factory=list)
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.outcome = "error"
+            if getattr(e, "timings", None) is None:
+                e.timings = self
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            self.phases[name] = self.phases.get(name, 0.0) + elapsed
+
+    @property
+    def total(self) -> float:
+        return sum(self.phases.values())
+
+
+def connect(path: Path = DB_PATH) -> sqlite3.Connection:
+    conn = sqlite3.connect(str(path), timeout=10)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def record(results: Iterable, path: Path = DB_PATH):
+    """Save the timings attached to the readings of a cycle.
+
+    Readings without any phase timed, the ones that never started, aren't saved, they
+    would count as instant readings.
+    """
+    rows, gauges = [], []
+    for _, values in results:
+        for read in values.values():
+            timings = getattr(read, "timings", None)
+            if timings is None:
+                continue
+            for attempt in [*timings.retried, timings]:
+                if not attempt.phases:
+                    continue  # never started (skipped, carried over...)
+                key = (attempt.username, str(attempt.started), attempt.outcome)
+                phases = dict(attempt.phases, total=attempt.total)
+                rows.extend((*key, *item) for item in phases.items())
+                gauges.extend((*key, *item) for item in attempt.gauges.items())
+    if not rows:
+        return
+    with connect(path) as conn:
+        conn.executemany("INSERT INTO timings VALUES (?, ?, ?, ?, ?)", rows)
+        conn.executemany("INSERT INTO gauges VALUES (?, ?, ?, ?, ?)", gauges)
+    conn.close()
+
+
+def record_cycle(report, path: Path = DB_PATH):
+    """Save how a cycle went, `cause` is only set when it overran its interval."""
+    with connect(path) as conn:
+        conn.execute(
+            "INSERT INTO cycles VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                str(report.started),
+                report.seconds,
+                report.interval,
+                report.users,
+                report.failed,
+                report.carried,
+                report.cause,
+            ),
+        )
+    conn.close()
+
+
+def process_tree_rss_mb(pid: int) -> float:
+    """Resident memory of a process and all its children, in MB.
+
+    For a driver, geckodriver plus Firefox and its content processes. Linux only, None
+    elsewhere.
+    """
+    children: dict = {}
+    rss: dict = {}
+    try:
+        for entry in os.listdir("/proc"):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f"/proc/{entry}/status") as f:
+                    status = dict(line.split(":", 1) for line in f if ":" in line)
+            except OSError:
+                continue  # process already gone
+            children.setdefault(int(status["PPid"]), []).append(int(entry))
+            rss[int(entry)] = int(status.get("VmRSS", "0 kB").split()[0])
+    except FileNotFoundError:
+        return None
+    if pid not in rss:
+        return None
+    total, pending = 0, [pid]
+    while pending:
+        current = pending.pop()
+        total += rss.get(current, 0)
+        pending.extend(children.get(current, []))
+    return round(total / 1024, 1)
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Linear interpolated percentile of sorted values, q between 0 and 100."""
+    if len(values) == 1:
+        return values[0]
+    pos = (len(values) - 1) * q / 100
+    low = int(pos)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (pos - low)
+
+
+def _stats(values: List[float]) -> dict:
+    values = sorted(values)
+    return {
+        "count": len(values),
+        "p50": round(percentile(values, 50), 3),
+        "p95": round(percentile(values, 95), 3),
+    }
+
+
+def summary(since: datetime.datetime = None, path: Path = DB_PATH) -> dict:
+    """p50/p95 seconds per phase, per user and phase, outcomes and overruns count.
+
+    Gauges are summarized apart, in their own units (`rss_mb` in MB).
+    """
+    query = "SELECT dni, outcome, phase, seconds FROM timings"
+    params: tuple = ()
+    if since is not None:
+        query += " WHERE started >= ?"
+        params = (str(since),)
+    by_phase: dict = defaultdict(list)
+    by_user: dict = defaultdict(lambda: defaultdict(list))
+    outcomes: dict = defaultdict(int)
+    conn = connect(path)
+    for dni, outcome, phase, seconds in conn.execute(query, params):
+        by_phase[phase].append(seconds)
+        by_user[dni][phase].append(seconds)
+        if phase == "total":
+            outcomes[outcome] += 1
+    by_gauge: dict = defaultdict(list)
+    for gauge, value in conn.execute(
+        "SELECT gauge, value FROM gauges"
+        + (" WHERE started >= ?" if since is not None else ""),
+        params,
+    ):
+        by_gauge[gauge].append(value)
+    overruns = dict(
+        conn.execute(
+            "SELECT cause, COUNT(*) FROM cycles WHERE cause IS NOT NULL"
+            + (" AND started >= ?" if since is not None else "")
+            + " GROUP BY cause",
+            params,
+        ).fetchall()
+    )
+    conn.close()
+    return {
+        "phases": {phase: _stats(values) for phase, values in by_phase.items()},
+        "users": {
+            dni: {phase: _stats(values) for phase, values in phases.items()}
+            for dni, phases in by_user.items()
+        },
+        "gauges": {gauge: _stats(values) for gauge, values in by_gauge.items()},
+        "outcomes": dict(outcomes),
+        "overruns": overruns,
+    }
+
+
+if __name__ == "__main__":
+    stats = summary()
+    print(f"{'fase':<20}{'n':>8}{'p50 [s]':>10}{'p95 [s]':>10}")
+    for phase, values in stats["phases"].items():
+        print(f"{phase:<20}{values['count']:>8}{values['p50']:>10}{values['p95']:>10}")
+    print()
+    print(f"{'medida':<20}{'n':>8}{'p50':>10}{'p95':>10}")
+    for gauge, values in stats["gauges"].items():
+        print(f"{gauge:<20}{values['count']:>8}{values['p50']:>10}{values['p95']:>10}")
+    print()
+    for dni, phases in stats["users"].items():
+        total = phases["total"]
+        print(f"{dni:<20}{total['count']:>8}{total['p50']:>10}{total['p95']:>10}")
+    print()
+    print(stats["outcomes"])
+    print(stats["overruns"])
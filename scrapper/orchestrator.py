@@ -0,0 +1,302 @@
+"""Reading cycles driven by asyncio with a bounded number of concurrent readings."""
+
+import asyncio
+import datetime
+import queue
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Tuple
+
+from scrapper.breaker import CircuitBreaker
+from scrapper.contador import SingleReadData, info_log
+from scrapper.metrics import ReadTimings
+
+Result = Tuple[bool, Dict[str, SingleReadData]]
+
+# outcome of the users that couldn't start before the cycle deadline
+CARRIED = "carried_over"
+
+# cycles running in this process by id, see `cancel_cycles`
+_running: Dict[int, "Cycle"] = {}
+_running_lock = threading.Lock()
+
+
+def failed_result(
+    user: dict, outcome: str = "error", timings: ReadTimings = None
+) -> Result:
+    """Same result a reader gives back when it can't get the values, with the `timings`
+    of the phases done before failing if there are any."""
+    date = datetime.datetime.now()
+    if timings is None:
+        timings = ReadTimings(user["username"])
+    timings.outcome = outcome
+    read = SingleReadData(date, None, None, None, timings=timings)
+    return (False, {user["username"]: read})
+
+
+def stagger_offsets(users: List[dict], window: float) -> Dict[str, float]:
+    """Seconds after the cycle start at which each user is read.
+
+    Users are spread evenly over `window`, in an order given by a hash of their DNI, so
+    everyone keeps about the same slot across cycles and restarts.
+    """
+    dnis = sorted((u["username"] for u in users), key=lambda d: zlib.crc32(d.encode()))
+    step = window / len(dnis) if dnis else 0
+    return {dni: n * step for n, dni in enumerate(dnis)}
+
+
+def stagger_window(
+    interval: float, fraction: float, timeout: float, margin: float
+) -> float:
+    """Seconds over which the first attempts of a cycle are spread, the `fraction` of
+    the interval as long as the last user can still take up to `timeout` seconds before
+    the cycle deadline (`margin` seconds before the next one)."""
+    return max(min(interval * fraction, interval - timeout - margin), 0)
+
+
+def interval_start(minutes: float, now: datetime.datetime = None) -> datetime.datetime:
+    """Last interval boundary counted from the epoch, cycles started from it are aligned
+    to wall clock multiples of the interval (xx:00, xx:10, ... every 10 minutes)."""
+    now = now or datetime.datetime.now()
+    seconds = minutes * 60
+    return datetime.datetime.fromtimestamp(now.timestamp() // seconds * seconds)
+
+
+def cycle_deadline(interval: float, margin: float) -> float:
+    """Seconds a scheduled cycle can run. It must return `margin` seconds before the next
+    one is due, for the bookkeeping and the pending writes, or the scheduler skips it
+    (a job doesn't overlap with itself)."""
+    return max(interval - margin, 0)
+
+
+@dataclass
+class Cycle:
+    """Read a list of users, at most `concurrency` of them at the same time.
+
+    `reader` takes a user dict and returns a result tuple. Blocking readers (selenium) run
+    in a thread executor, coroutine functions are awaited directly. A reading that takes
+    longer than `timeout` seconds is given up and counted as failed.
+
+    Failed readings are retried up to `retries` times, waiting `backoff` seconds before
+    the first retry and doubling it on each one. While waiting they don't hold a worker,
+    and once done they queue behind the users not read yet. No retry starts if it can't
+    finish before `deadline` seconds from the cycle start.
+
+    With `stagger` the first attempt of every user is delayed to its own slot within the
+    first `stagger` seconds of the cycle, instead of starting all of them at once.
+
+    While the `breaker` is open, attempts wait for it to close (or are skipped right away
+    without `delay`), skipped ones are counted as failed but not retried.
+
+    Users that can't start before the deadline are given back as carried over, the ones in
+    `priority` (carried over from the previous cycle) start first.
+
+    `on_result` is called with every result as soon as its user is done, in completion
+    order. It runs in the event loop, so it must not block (see `ResultWriter`).
+    """
+
+    users: List[dict]
+    reader: Callable
+    concurrency: int = 4
+    timeout: float = 300
+    retries: int = 2
+    backoff: float = 5
+    deadline: float = None
+    stagger: float = 0
+    breaker: CircuitBreaker = None
+    delay: bool = True
+    priority: List[str] = field(default_factory=list)
+    on_result: Callable = None
+    _tasks: List[asyncio.Task] = field(default_factory=list, init=False)
+
+    async def run(self) -> List[Result]:
+        """Read all the users, results are in the same order than users."""
+        self._start = time.monotonic()
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._offsets = stagger_offsets(self.users, self.stagger)
+        self._offsets.update(dict.fromkeys(self.priority, 0))
+        # a timed out thread can't be stopped, extra workers keep the concurrency
+        # while it finishes in the background
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(self.concurrency, len(self.users))
+        )
+        self._loop = asyncio.get_event_loop()
+        self._tasks = [asyncio.ensure_future(self._read(user)) for user in self.users]
+        with _running_lock:
+            _running[id(self)] = self
+        try:
+            return await asyncio.gather(*self._tasks)
+        finally:
+            with _running_lock:
+                del _running[id(self)]
+            self._executor.shutdown(wait=False)
+
+    def cancel(self):
+        """Stop the cycle, readings not finished yet are counted as cancelled. Can be
+        called from any thread while the cycle runs."""
+
+        def cancel_tasks():
+            for task in self._tasks:
+                task.cancel()
+
+        self._loop.call_soon_threadsafe(cancel_tasks)
+
+    def remaining(self) -> float:
+        """Seconds left until the cycle deadline."""
+        if self.deadline is None:
+            return float("inf")
+        return self.deadline - (time.monotonic() - self._start)
+
+    async def _read(self, user: dict) -> Result:
+        result = await self._read_user(user)
+        if self.on_result is not None:
+            try:
+                self.on_result(result)
+            except Exception as e:
+                info_log.error(f"[{user['username']}] Lectura no guardada {e!r}")
+        return result
+
+    async def _read_user(self, user: dict) -> Result:
+        try:
+            await asyncio.sleep(self._offsets[user["username"]])
+        except asyncio.CancelledError:
+            return failed_result(user, "cancelled")
+        result = await self._attempt(user)
+        retried = []
+        for retry in range(1, self.retries + 1):
+            read = result[1][user["username"]]
+            if result[0] or outcome(read) in ("cancelled", "skipped", CARRIED):
+                break
+            delay = self.backoff * 2 ** (retry - 1)
+            if self.remaining() < delay:
+                info_log.error(f"[{user['username']}] Sin tiempo para reintentar")
+                break
+            info_log.info(f"[{user['username']}] Reintento {retry} en {delay}s")
+            try:
+                await asyncio.sleep(delay)
+            except asyncio.CancelledError:
+                return result
+            if read.timings is not None:
+                retried.append(read.timings)
+            result = await self._attempt(user)
+            timings = getattr(result[1][user["username"]], "timings", None)
+            if timings is not None:
+                timings.retried = list(retried)
+        if not result[0]:
+            info_log.error(f"[{user['username']}] Lectura fallada en este ciclo")
+        return result
+
+    async def _attempt(self, user: dict) -> Result:
+        while True:
+            try:
+                async with self._semaphore:
+                    if self.remaining() <= 0:
+                        info_log.error(f"[{user['username']}] Pasa al siguiente ciclo")
+                        return failed_result(user, CARRIED)
+                    # checked once a worker is free, with the latest readings recorded
+                    if self.breaker is None or self.breaker.allow():
+                        return await self._guarded(user)
+            except asyncio.CancelledError:
+                info_log.error(f"[{user['username']}] Lectura cancelada")
+                return failed_result(user, "cancelled")
+            wait = self.breaker.retry_after()
+            if not self.delay or self.remaining() < wait:
+                info_log.error(f"[{user['username']}] Portal con errores, lectura saltada")
+                return failed_result(user, "skipped")
+            try:
+                await asyncio.sleep(wait)
+            except asyncio.CancelledError:
+                return failed_result(user, "cancelled")
+
+    async def _guarded(self, user: dict) -> Result:
+        result = await self._timed(user)
+        if self.breaker is not None:
+            cancelled = outcome(result[1][user["username"]]) == "cancelled"
+            self.breaker.record(None if cancelled else result[0], user["username"])
+        return result
+
+    async def _timed(self, user: dict) -> Result:
+        started, start = datetime.datetime.now(), time.perf_counter()
+        try:
+            timeout = min(self.timeout, max(self.remaining(), 0))
+            return await asyncio.wait_for(self._call(user), timeout)
+        except asyncio.TimeoutError:
+            info_log.error(f"[{user['username']}] Lectura cancelada, tiempo agotado")
+            # the reader's own timings are still in use by its thread
+            timings = ReadTimings(
+                user["username"],
+                phases={"timeout": time.perf_counter() - start},
+                started=started,
+            )
+            return failed_result(user, "timeout", timings)
+        except asyncio.CancelledError:
+            info_log.error(f"[{user['username']}] Lectura cancelada")
+            return failed_result(user, "cancelled")
+        except Exception as e:
+            info_log.error(f"[{user['username']}] Lectura fallada {e!r}")
+            return failed_result(user, timings=getattr(e, "timings", None))
+
+    async def _call(self, user: dict) -> Result:
+        if asyncio.iscoroutinefunction(self.reader):
+            return await self.reader(user)
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, self.reader, user)
+
+
+class ResultWriter:
+    """Single thread writing results one by one, as the cycle hands them over.
+
+    Readings are saved while the rest of the cycle goes on, without blocking the event
+    loop, and a single writer means no concurrent writes to the database.
+    """
+
+    def __init__(self, write: Callable):
+        self.write = write
+        self._queue: queue.Queue = queue.Queue()
+        self._thread = threading.Thread(target=self._consume, daemon=True)
+        self._thread.start()
+
+    def put(self, result: Result):
+        self._queue.put(result)
+
+    def close(self):
+        """Wait until all the results are written."""
+        self._queue.put(None)
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _consume(self):
+        while True:
+            result = self._queue.get()
+            if result is None:
+                return
+            try:
+                self.write(result)
+            except Exception as e:
+                info_log.error(f"{list(result[1])} Lectura no guardada {e!r}")
+
+
+def outcome(read: SingleReadData) -> str:
+    """How a reading ended, None if unknown."""
+    timings = getattr(read, "timings", None)
+    return timings.outcome if timings is not None else None
+
+
+def cancel_cycles():
+    """Stop the cycles running in this process, when the readings are stopped."""
+    with _running_lock:
+        for cycle in _running.values():
+            cycle.cancel()
+
+
+def run_cycle(users: List[dict], reader: Callable, **kwargs) -> List[Result]:
+    """Blocking entrypoint, to be called from the scheduler threads."""
+    return asyncio.run(Cycle(users, reader, **kwargs).run())
@@ -0,0 +1,124 @@
+"""Bounded pool of long lived browser drivers."""
+
+import logging
+import queue
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Callable, Dict
+
+from selenium.common.exceptions import (  # type: ignore
+    JavascriptException,
+    WebDriverException,
+)
+
+log = logging.getLogger(__name__)
+
+CLEAR_STORAGE = "window.localStorage.clear(); window.sessionStorage.clear();"
+
+
+@dataclass
+class DriverPool:
+    """Keep a bounded set of warm drivers to be borrowed by the readers.
+
+    Launching Firefox and geckodriver is the most expensive step of a reading, so drivers
+    are kept alive between users and between cycles. Every driver is health checked
+    before being handed out, cleaned (cookies and storage) when returned and recycled
+    after `max_uses` readings.
+    """
+
+    factory: Callable
+    size: int = 4
+    max_uses: int = 20
+    _idle: queue.LifoQueue = field(default_factory=queue.LifoQueue, init=False)
+    _uses: Dict[int, int] = field(default_factory=dict, init=False)
+    _closed: bool = field(default=False, init=False)
+
+    def __post_init__(self):
+        # one slot per driver that may be alive at the same time
+        self._slots = threading.BoundedSemaphore(self.size)
+
+    def acquire(self, timeout: float = None):
+        """Get a healthy driver, launching a new one if there isn't a warm one.
+
+        Raises TimeoutError if no driver was released within `timeout` seconds.
+        """
+        if not self._slots.acquire(timeout=timeout):
+            raise TimeoutError("No browser driver available in the pool")
+        try:
+            while True:
+                try:
+                    driver = self._idle.get_nowait()
+                except queue.Empty:
+                    driver = self.factory()
+                    self._uses[id(driver)] = 0
+                    return driver
+                if self._healthy(driver):
+                    return driver
+                log.warning("Discarding unresponsive browser driver")
+                self._discard(driver)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, driver):
+        """Give a driver back to the pool, or quit it when it's worn out."""
+        uses = self._uses.get(id(driver), 0) + 1
+        self._uses[id(driver)] = uses
+        if self._closed or uses >= self.max_uses or not self._reset(driver):
+            self._discard(driver)
+        else:
+            self._idle.put(driver)
+        self._slots.release()
+
+    @contextmanager
+    def borrow(self, timeout: float = None):
+        """Context manager version of acquire/release."""
+        driver = self.acquire(timeout)
+        try:
+            yield driver
+        finally:
+            self.release(driver)
+
+    def close(self):
+        """Quit idle drivers. Drivers still in use are quit when released."""
+        self._closed = True
+        while True:
+            try:
+                self._discard(self._idle.get_nowait())
+            except queue.Empty:
+                break
+
+    @property
+    def idle(self) -> int:
+        return self._idle.qsize()
+
+    def _discard(self, driver):
+        self._uses.pop(id(driver), None)
+        try:
+            driver.quit()
+        except WebDriverException:
+            pass
+
+    @staticmethod
+    def _healthy(driver) -> bool:
+        """A driver whose session died raises on any command."""
+        try:
+            driver.current_url
+            return True
+        except WebDriverException:
+            return False
+
+    @staticmethod
+    def _reset(driver) -> bool:
+        """Remove any trace of the previous user from the driver."""
+        try:
+            driver.delete_all_cookies()
+            try:
+                driver.execute_script(CLEAR_STORAGE)
+            except JavascriptException:
+                pass  # pages like about:blank have no storage to clear
+            driver.get("about:blank")
+            return True
+        except WebDriverException:
+            return False
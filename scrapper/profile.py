@@ -0,0 +1,88 @@
+"""Lean Firefox profile, without the heavy assets the portal doesn't need to read."""
+
+import json
+import os
+import threading
+from pathlib import Path
+from urllib.parse import quote
+
+TEMPLATES = Path(__file__).parent / "profiles"
+
+# Hosts that only serve analytics or ads, requests to them go to a dead proxy
+BLOCKED_HOSTS = [
+    "google-analytics.com",
+    "googletagmanager.com",
+    "doubleclick.net",
+    "facebook.net",
+    "hotjar.com",
+]
+
+LEAN_PREFERENCES = {
+    # images, media and fonts
+    "permissions.default.image": 2,
+    "media.autoplay.default": 5,
+    "media.peerconnection.enabled": False,
+    "gfx.downloadable_fonts.enabled": False,
+    "browser.display.use_document_fonts": 0,
+    # trackers and analytics
+    "privacy.trackingprotection.enabled": True,
+    # no disk cache, a small memory one
+    "browser.cache.disk.enable": False,
+    "browser.cache.memory.enable": True,
+    "browser.sessionhistory.max_entries": 2,
+    # background traffic
+    "network.prefetch-next": False,
+    "network.dns.disablePrefetch": True,
+    "network.http.speculative-parallel-limit": 0,
+    "app.update.auto": False,
+    "browser.safebrowsing.malware.enabled": False,
+    "browser.safebrowsing.phishing.enabled": False,
+    "datareporting.healthreport.uploadEnabled": False,
+    "datareporting.policy.dataSubmissionEnabled": False,
+    "toolkit.telemetry.enabled": False,
+    "extensions.pocket.enabled": False,
+}
+
+
+def pac_script(hosts: list) -> str:
+    """Proxy auto-config sending blocked hosts to a port where nothing listens."""
+    checks = " || ".join(f'dnsDomainIs(host, "{host}")' for host in hosts)
+    script = (
+        "function FindProxyForURL(url, host) {"
+        f' if ({checks or "false"}) return "PROXY 127.0.0.1:9"; return "DIRECT"; }}'
+    )
+    return "data:text/javascript," + quote(script)
+
+
+def lean_preferences(cfg: dict) -> dict:
+    """Lean preferences adjusted with the browser config."""
+    prefs = dict(LEAN_PREFERENCES)
+    prefs["browser.cache.memory.capacity"] = cfg.get("cache_kb", 16384)
+    if cfg.get("block_css", False):
+        # the portal still works, but with a broken layout clicks may land elsewhere
+        prefs["permissions.default.stylesheet"] = 2
+    hosts = cfg.get("blocked_hosts", BLOCKED_HOSTS)
+    if hosts:
+        prefs["network.proxy.type"] = 2
+        prefs["network.proxy.autoconfig_url"] = pac_script(hosts)
+    return prefs
+
+
+def lean_profile(cfg: dict, path: Path = TEMPLATES / "lean") -> str:
+    """Get the on-disk profile template, (re)built only when preferences change.
+
+    Selenium copies the template for every new driver, which is cheaper than writing
+    the preferences of a new profile each time.
+    """
+    user_js = "".join(
+        f"user_pref({json.dumps(k)}, {json.dumps(v)});\n"
+        for k, v in sorted(lean_preferences(cfg).items())
+    )
+    prefs_file = path / "user.js"
+    if not prefs_file.exists() or prefs_file.read_text() != user_js:
+        path.mkdir(parents=True, exist_ok=True)
+        # several drivers may be launched at once, never leave a half written file
+        tmp = prefs_file.with_suffix(f".{os.getpid()}-{threading.get_ident()}.tmp")
+        tmp.write_text(user_js)
+        os.replace(tmp, prefs_file)
+    return str(path)
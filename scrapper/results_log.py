@@ -0,0 +1,152 @@
+"""Append-only log of the readings, one json line per reading.
+
+Each cycle appends its readings with a single write, so saving doesn't depend on the size
+of the history and a power cut can only lose the last, incomplete line. The current file
+is rotated once it's too big or too old, and rotated segments are gzipped.
+
+Usage:
+    python -m scrapper.results_log [dni]  # print the history
+"""
+
+import datetime
+import gzip
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterator, List, Tuple
+
+from scrapper.contador import SingleReadData, base_path, get_config
+
+CURRENT = "current.jsonl"
+
+# rotation and writes of the threads of a process, O_APPEND keeps the writes of
+# different processes whole
+_lock = threading.Lock()
+
+
+@dataclass
+class ResultsLog:
+    """Results log on `path` folder, rotated after `max_mb` MB or `max_days` days."""
+
+    path: Path
+    max_mb: float = 10
+    max_days: float = 30
+    compress: bool = True
+
+    @property
+    def current(self) -> Path:
+        return self.path / CURRENT
+
+    def append(self, results: List) -> int:
+        """Save the succeed readings of a cycle, returns the number of lines written."""
+        lines = [
+            json.dumps({"dni": dni, "read": read.to_tuple(True)}) + "\n"
+            for succeed, values in results
+            if succeed
+            for dni, read in values.items()
+        ]
+        if not lines:
+            return 0
+        with _lock:
+            self.path.mkdir(parents=True, exist_ok=True)
+            self._rotate_if_needed()
+            fd = os.open(self.current, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                data = "".join(lines)
+                size = os.fstat(fd).st_size
+                # end the line cut by a power loss, or the first reading would join it
+                if size and os.pread(fd, 1, size - 1) != b"\n":
+                    data = "\n" + data
+                os.write(fd, data.encode())
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        return len(lines)
+
+    def _rotate_if_needed(self):
+        try:
+            stat = self.current.stat()
+        except FileNotFoundError:
+            return
+        too_big = stat.st_size >= self.max_mb * 1024 * 1024
+        # the first line was written when the file was created
+        too_old = time.time() - self._created() >= self.max_days * 86400
+        if too_big or too_old:
+            self.rotate()
+
+    def _created(self) -> float:
+        with open(self.current) as f:
+            first = f.readline()
+        try:
+            date = json.loads(first)["read"][0]
+        except (ValueError, KeyError):
+            return self.current.stat().st_mtime
+        return datetime.datetime.strptime(date, "%d-%m-%Y_%H:%M:%S").timestamp()
+
+    def rotate(self):
+        """Close the current file as a new segment."""
+        stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        segment = self.path / f"results-{stamp}.jsonl"
+        try:
+            os.replace(self.current, segment)
+        except FileNotFoundError:
+            return  # just rotated by another process
+        if self.compress:
+            with open(segment, "rb") as src, gzip.open(f"{segment}.gz", "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(segment)
+
+    def segments(self) -> List[Path]:
+        """All the files of the log, oldest first."""
+        rotated = sorted(self.path.glob("results-*.jsonl*"))
+        if self.current.exists():
+            rotated.append(self.current)
+        return rotated
+
+    def read(self, dni: str = None) -> Iterator[Tuple[str, SingleReadData]]:
+        """Stream the history, optionally of a single user, oldest first."""
+        for segment in self.segments():
+            opener = gzip.open if segment.suffix == ".gz" else open
+            with opener(segment, "rt") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # line cut by a power loss
+                    if dni is None or entry["dni"] == dni:
+                        yield entry["dni"], SingleReadData.from_tuple(entry["read"])
+
+
+def results_log() -> ResultsLog:
+    """Results log set in the config file."""
+    cfg = get_config().get("results", {})
+    return ResultsLog(
+        base_path / cfg.get("path", "results"),
+        max_mb=cfg.get("max_mb", 10),
+        max_days=cfg.get("max_days", 30),
+        compress=cfg.get("compress", True),
+    )
+
+
+def history(dni: str = None) -> Iterator[Tuple[str, SingleReadData]]:
+    """Readings saved in `results.json` before the log existed, then the log ones."""
+    try:
+        with open(base_path / "results.json") as f:
+            legacy = json.load(f)
+    except FileNotFoundError:
+        legacy = {}
+    for user, reads in legacy.items():
+        if dni is None or user == dni:
+            for read in reads:
+                yield user, SingleReadData.from_tuple(read)
+    yield from results_log().read(dni)
+
+
+if __name__ == "__main__":
+    for user, read in history(sys.argv[1] if len(sys.argv) > 1 else None):
+        print(user, *read.to_tuple(True))
@@ -11,6 +11,7 @@ from scrapper import contador
 
 error_log = logging.getLogger(__name__)
 error_log.setLevel(logging.ERROR)
+error_log.propagate = False
 handler = logging.FileHandler(filename="logs/error.log", mode="a")
 logger_formatter = logging.Formatter("[%(levelname)s] - %(message)s")
 handler.setFormatter(logger_formatter)
@@ -49,6 +50,6 @@ def single():
 
 
 @run_safe
-def multiple(pool, users, save: bool):
-    """Run script inside a thread pool."""
-    return contador.read_multiple(pool, users, save)
+def multiple(users, save: bool, on_result=None):
+    """Run script reading several users at the same time."""
+    return contador.read_multiple(users, save, on_result=on_result)
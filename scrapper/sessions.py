@@ -0,0 +1,61 @@
+"""Authenticated portal sessions kept between reading cycles."""
+
+import json
+import os
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+# Cookie fields accepted back by `driver.add_cookie`
+COOKIE_KEYS = {"name", "value", "path", "domain", "secure", "httpOnly", "expiry"}
+
+
+@dataclass
+class SessionStore:
+    """Save cookies and local storage of each user, one file per DNI."""
+
+    path: Path
+
+    def load(self, dni: str) -> Optional[dict]:
+        """Get the stored session of a user, None if there is no usable session."""
+        try:
+            with open(self._file(dni)) as f:
+                session = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        now = time.time()
+        session["cookies"] = [
+            cookie
+            for cookie in session["cookies"]
+            if cookie.get("expiry") is None or cookie["expiry"] > now
+        ]
+        if not session["cookies"]:
+            return None
+        return session
+
+    def save(self, dni: str, cookies: list, local_storage: dict):
+        """Store a user session. Written to a temp file first so it's never left half written."""
+        self.path.mkdir(parents=True, exist_ok=True)
+        session = {
+            "saved": time.time(),
+            "cookies": [
+                {k: v for k, v in cookie.items() if k in COOKIE_KEYS}
+                for cookie in cookies
+            ],
+            "local_storage": local_storage or {},
+        }
+        tmp = self._file(dni).with_suffix(".tmp")
+        with open(tmp, "w") as f:
+            json.dump(session, f)
+        os.replace(tmp, self._file(dni))
+
+    def forget(self, dni: str):
+        """Remove an expired session."""
+        try:
+            self._file(dni).unlink()
+        except FileNotFoundError:
+            pass
+
+    def _file(self, dni: str) -> Path:
+        return self.path / f"{dni}.json"
@@ -0,0 +1,748 @@
+import asyncio
+import datetime
+import os
+import threading
+import time
+from pathlib import Path
+from urllib.parse import unquote
+
+import pytest
+import requests
+from selenium.common.exceptions import WebDriverException
+
+from scrapper import contador, metrics, work_queue
+from scrapper.benchmarks import synthetic_page
+from scrapper.breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+from scrapper.concurrency import ConcurrencyController
+from scrapper.cycles import CyclePlanner
+from scrapper.contador import (
+    ReadConsumption,
+    SingleReadData,
+    _parse_values_bs4,
+    parse_values,
+)
+from scrapper.fake_portal import FakePortal
+from scrapper.http_reader import HttpReadConsumption
+from scrapper.metrics import ReadTimings
+from scrapper.orchestrator import (
+    ResultWriter,
+    cancel_cycles,
+    cycle_deadline,
+    failed_result,
+    interval_start,
+    run_cycle,
+    stagger_offsets,
+    stagger_window,
+)
+from scrapper.pool import DriverPool
+from scrapper.profile import lean_profile
+from scrapper.results_log import ResultsLog
+from scrapper.sessions import SessionStore
+from scrapper.work_queue import WorkQueue, ingest_url, work
+
+
+class FakeDriver:
+    """Minimal stand in of a selenium webdriver."""
+
+    def __init__(self):
+        self.alive = True
+        self.cookies = ["session"]
+        self.quitted = False
+
+    @property
+    def current_url(self):
+        if not self.alive:
+            raise WebDriverException("session deleted")
+        return "about:blank"
+
+    def delete_all_cookies(self):
+        self.cookies = []
+
+    def execute_script(self, script, *args):
+        return None
+
+    def get(self, url):
+        pass
+
+    def quit(self):
+        self.quitted = True
+
+
+@pytest.fixture
+def driver_pool():
+    return DriverPool(FakeDriver, size=2, max_uses=3)
+
+
+def test_pool_reuses_released_drivers(driver_pool):
+    with driver_pool.borrow() as first:
+        pass
+    with driver_pool.borrow() as second:
+        pass
+    assert first is second
+    assert first.cookies == []
+
+
+def test_pool_is_bounded(driver_pool):
+    driver_pool.acquire()
+    driver_pool.acquire()
+    with pytest.raises(TimeoutError):
+        driver_pool.acquire(timeout=0.01)
+
+
+def test_pool_recycles_worn_out_drivers(driver_pool):
+    for _ in range(3):
+        with driver_pool.borrow() as driver:
+            pass
+    assert driver.quitted
+    with driver_pool.borrow() as new_driver:
+        assert new_driver is not driver
+
+
+def test_pool_discards_dead_drivers(driver_pool):
+    with driver_pool.borrow() as driver:
+        pass
+    driver.alive = False
+    with driver_pool.borrow() as new_driver:
+        assert new_driver is not driver
+    assert driver.quitted
+
+
+def test_pool_close_quits_idle_drivers(driver_pool):
+    with driver_pool.borrow() as driver:
+        pass
+    driver_pool.close()
+    assert driver.quitted
+    assert driver_pool.idle == 0
+
+
+def test_session_store_round_trip(tmp_path):
+    store = SessionStore(tmp_path)
+    cookies = [
+        {"name": "sid", "value": "1", "domain": "x", "sameSite": "None"},
+        {"name": "old", "value": "2", "expiry": 1},
+    ]
+    store.save("12345678A", cookies, {"key": "value"})
+    session = store.load("12345678A")
+    assert session["cookies"] == [{"name": "sid", "value": "1", "domain": "x"}]
+    assert session["local_storage"] == {"key": "value"}
+    store.forget("12345678A")
+    assert store.load("12345678A") is None
+
+
+@pytest.fixture
+def portal():
+    portal = FakePortal().start()
+    yield portal
+    portal.stop()
+
+
+def test_http_reader_reading(portal):
+    succeed, values = HttpReadConsumption(
+        "12345678A", "pass", base_url=portal.url
+    ).get_reading()
+    assert succeed is True
+    read = values["12345678A"]
+    assert isinstance(read, SingleReadData)
+    assert 0 <= read.power <= read.max_power
+
+
+def test_http_reader_failed_reading(portal):
+    portal.error_rate = 1
+    succeed, values = HttpReadConsumption(
+        "12345678A", "pass", base_url=portal.url
+    ).get_reading()
+    assert succeed is False
+    assert values["12345678A"].power is None
+
+
+def test_http_reader_wrong_password(portal):
+    portal.users["12345678A"] = "pass"
+    succeed, _ = HttpReadConsumption(
+        "12345678A", "wrong", base_url=portal.url
+    ).get_reading()
+    assert succeed is False
+
+
+def test_http_reader_reuses_session(portal, tmp_path):
+    store = SessionStore(tmp_path)
+    for _ in range(2):
+        reader = HttpReadConsumption(
+            "12345678A", "pass", base_url=portal.url, sessions=store
+        )
+        assert reader.get_reading()[0] is True
+    assert portal.logins == 1
+    portal.expire_sessions()
+    reader = HttpReadConsumption(
+        "12345678A", "pass", base_url=portal.url, sessions=store
+    )
+    assert reader.get_reading()[0] is True
+    assert portal.logins == 2
+
+
+def test_cycle_bounded_concurrency():
+    running, peak = 0, 0
+    lock = threading.Lock()
+
+    def reader(user):
+        nonlocal running, peak
+        with lock:
+            running += 1
+            peak = max(peak, running)
+        time.sleep(0.02)
+        with lock:
+            running -= 1
+        return (True, {user["username"]: None})
+
+    users = [{"username": str(n), "password": ""} for n in range(10)]
+    results = run_cycle(users, reader, concurrency=3)
+    assert peak == 3
+    assert [list(values) for _, values in results] == [[u["username"]] for u in users]
+
+
+def test_cycle_timeout_and_errors():
+    def reader(user):
+        if user["username"] == "slow":
+            time.sleep(0.5)
+        if user["username"] == "broken":
+            raise RuntimeError("browser crashed")
+        return (True, {user["username"]: None})
+
+    users = [{"username": name} for name in ("slow", "broken", "ok")]
+    results = run_cycle(users, reader, timeout=0.1, retries=0)
+    assert [succeed for succeed, _ in results] == [False, False, True]
+    assert results[0][1]["slow"].power is None
+
+
+def test_cycle_async_reader():
+    async def reader(user):
+        await asyncio.sleep(0.01)
+        return (True, {user["username"]: None})
+
+    users = [{"username": str(n)} for n in range(50)]
+    results = run_cycle(users, reader, concurrency=50)
+    assert all(succeed for succeed, _ in results)
+
+
+class FakePage:
+    """Driver whose page shows `selector` after `polls` checks."""
+
+    def __init__(self, selector, polls):
+        self.selector = selector
+        self.polls = polls
+        self.clicked = False
+
+    def find_elements_by_css_selector(self, selector):
+        if selector == ".percent":
+            self.polls -= 1
+        if self.polls <= 0 and selector == self.selector:
+            return [self]
+        return []
+
+    def click(self):
+        self.clicked = True
+
+
+def reader_for(page):
+    cfg = {"timeout": 1, "poll_interval": 0.01}
+    return ReadConsumption(username="12345678A", driver=page, cfg=cfg)
+
+
+def test_read_succeed_as_soon_as_values_show_up():
+    page = FakePage(".percent", polls=3)
+    start = time.perf_counter()
+    assert reader_for(page)._read_succeed() is True
+    assert time.perf_counter() - start < 0.5
+
+
+def test_read_succeed_closes_error_popup():
+    page = FakePage("[title='ENTENDIDO']", polls=2)
+    assert reader_for(page)._read_succeed() is False
+    assert page.clicked
+
+
+def test_read_succeed_deadline():
+    reader = reader_for(FakePage(".other", polls=0))
+    reader.cfg["timeout"] = 0.05
+    assert reader._read_succeed() is False
+
+
+def test_metrics_record_and_summary(tmp_path):
+    db = tmp_path / "metrics.db"
+    results = []
+    for n in range(1, 11):
+        timings = ReadTimings(
+            "12345678A", outcome="ok", phases={"login": n, "lectura": 1}
+        )
+        timings.gauges["rss_mb"] = 100 * n
+        read = SingleReadData(None, 1, 1, 1, timings=timings)
+        results.append((True, {"12345678A": read}))
+    timeout = ReadTimings("87654321B", phases={"timeout": 300})
+    results.append(failed_result({"username": "87654321B"}, "timeout", timeout))
+    results.append(failed_result({"username": "87654321B"}, "carried_over"))
+    metrics.record(results, path=db)
+    stats = metrics.summary(path=db)
+    assert stats["phases"]["login"] == {"count": 10, "p50": 5.5, "p95": 9.55}
+    assert stats["users"]["12345678A"]["total"]["p50"] == 6.5
+    # gauges aren't phases, nor part of the total
+    assert "rss_mb" not in stats["phases"]
+    assert "rss_mb" not in stats["users"]["12345678A"]
+    assert stats["gauges"]["rss_mb"] == {"count": 10, "p50": 550, "p95": 955}
+    # the carried over user wasn't read, it doesn't count as an instant reading
+    assert stats["users"]["87654321B"]["total"] == {"count": 1, "p50": 300, "p95": 300}
+    assert stats["outcomes"] == {"ok": 10, "timeout": 1}
+
+
+def test_cycle_times_readings_cut_by_the_timeout():
+    def reader(user):
+        time.sleep(0.3)
+
+    results = run_cycle([{"username": "slow"}], reader, timeout=0.1, retries=0)
+    timings = results[0][1]["slow"].timings
+    assert timings.outcome == "timeout"
+    assert 0.1 <= timings.total < 0.3
+
+
+def test_read_timings_phases():
+    timings = ReadTimings("12345678A")
+    with timings.phase("login"):
+        time.sleep(0.01)
+    with timings.phase("login"):
+        pass
+    assert list(timings.phases) == ["login"]
+    assert timings.total >= 0.01
+
+
+def test_cycle_retries_failed_readings_with_backoff():
+    calls = []
+
+    def reader(user):
+        calls.append(user["username"])
+        if user["username"] == "flaky" and calls.count("flaky") < 3:
+            return failed_result(user, "failed")
+        return (True, {user["username"]: None})
+
+    users = [{"username": "flaky"}, {"username": "ok"}]
+    results = run_cycle(users, reader, concurrency=1, retries=2, backoff=0.01)
+    assert [succeed for succeed, _ in results] == [True, True]
+    # the retries wait without holding the only worker
+    assert calls == ["flaky", "ok", "flaky", "flaky"]
+
+
+def test_cycle_keeps_timings_of_failed_attempts(tmp_path):
+    def reader(user):
+        timings = ReadTimings(user["username"])
+        with timings.phase("login"):
+            pass
+        with timings.phase("contador_online"):
+            raise WebDriverException("sin contador")
+
+    users = [{"username": "12345678A"}]
+    results = run_cycle(users, reader, retries=1, backoff=0.01)
+    timings = results[0][1]["12345678A"].timings
+    assert timings.outcome == "error"
+    assert list(timings.phases) == ["login", "contador_online"]
+    assert [t.outcome for t in timings.retried] == ["error"]
+    assert list(timings.retried[0].phases) == ["login", "contador_online"]
+    metrics.record(results, path=tmp_path / "metrics.db")
+    stats = metrics.summary(path=tmp_path / "metrics.db")
+    assert stats["outcomes"] == {"error": 2}
+    assert stats["phases"]["contador_online"]["count"] == 2
+
+
+def test_cycle_retries_within_deadline():
+    calls = []
+
+    def reader(user):
+        calls.append(user["username"])
+        return failed_result(user, "failed")
+
+    users = [{"username": "down"}]
+    results = run_cycle(users, reader, retries=3, backoff=1, deadline=0.5)
+    assert results[0][0] is False
+    assert calls == ["down"]
+
+
+def test_parse_values_fast_path_matches_bs4():
+    page = synthetic_page(size=20_000)
+    assert parse_values(page) == _parse_values_bs4(page) == (1.22, 36.97, 3.3)
+
+
+def test_parse_values_falls_back_to_bs4():
+    page = (
+        "<div class='description'>Potencia Instantánea Actual2,5 kW</div>"
+        "<div class='percent'>50%</div><div class='max'><span>5 kW</span></div>"
+    )
+    assert parse_values(page) == (2.5, 50.0, 5.0)
+    with pytest.raises(IndexError):
+        parse_values("<html><div class='spinner'></div></html>")
+
+
+def test_lean_profile_template(tmp_path):
+    cfg = {"cache_kb": 1024, "blocked_hosts": ["hotjar.com"]}
+    path = Path(lean_profile(cfg, tmp_path / "lean"))
+    user_js = (path / "user.js").read_text()
+    assert 'user_pref("permissions.default.image", 2);' in user_js
+    assert 'user_pref("browser.cache.memory.capacity", 1024);' in user_js
+    assert "hotjar.com" in unquote(user_js)
+    assert "permissions.default.stylesheet" not in user_js
+    cfg["block_css"] = True
+    lean_profile(cfg, path)
+    assert "permissions.default.stylesheet" in (path / "user.js").read_text()
+
+
+def test_process_tree_rss():
+    assert metrics.process_tree_rss_mb(os.getpid()) > 0
+
+
+def test_work_queue_splits_users(tmp_path):
+    queue = WorkQueue(tmp_path / "queue.db")
+    queue.enqueue([{"username": str(n), "password": "pass"} for n in range(5)], "c1")
+    first = queue.claim("w1", 3)
+    second = queue.claim("w2", 3)
+    assert len(first) == 3 and len(second) == 2
+    assert not {u["username"] for u in first} & {u["username"] for u in second}
+    for user in first:
+        queue.complete("w1", user["username"], True)
+    queue.complete("w2", second[0]["username"], False)
+    assert queue.status() == {"done": 3, "failed": 1, "claimed": 1}
+
+
+def test_work_queue_reclaims_expired_leases(tmp_path):
+    queue = WorkQueue(tmp_path / "queue.db", lease=0.05, max_attempts=2)
+    queue.enqueue([{"username": "1", "password": "pass"}], "c1")
+    assert queue.claim("w1", 1)
+    assert queue.claim("w2", 1) == []  # still leased to w1
+    time.sleep(0.1)
+    assert queue.claim("w2", 1) == [{"username": "1", "password": "pass"}]
+    queue.complete("w1", "1", True)  # w1 lost the lease, ignored
+    assert queue.status() == {"claimed": 1}
+    time.sleep(0.1)
+    assert queue.claim("w3", 1) == []  # given up after max_attempts
+    assert queue.status() == {"failed": 1}
+    # a new cycle doesn't touch valid leases but resets the rest
+    queue.enqueue([{"username": "1", "password": "new"}], "c2")
+    assert queue.claim("w3", 1) == [{"username": "1", "password": "new"}]
+
+
+def test_worker_survives_connection_errors(tmp_path, monkeypatch):
+    queue = WorkQueue(tmp_path / "queue.db")
+    queue.enqueue([{"username": "1", "password": "pass"}], "c1")
+
+    def send_results(url, results, token=""):
+        raise requests.ConnectionError("UI caída")
+
+    sleeps = []
+    monkeypatch.setattr(work_queue, "ingest_url", lambda cfg: "http://ui/ingest")
+    monkeypatch.setattr(work_queue, "send_results", send_results)
+    monkeypatch.setattr(work_queue.time, "sleep", sleeps.append)
+    monkeypatch.setattr(
+        contador,
+        "read_multiple",
+        lambda users, **kwargs: [failed_result(user) for user in users],
+    )
+    work(queue, "w1", once=True)
+    assert sleeps == [1]  # backed off, then nothing left to claim
+    # not completed, read again by another worker once the lease expires
+    assert queue.status() == {"claimed": 1}
+
+
+def test_workers_send_readings_to_the_ui_queue():
+    assert ingest_url({}) == ""  # auto_run queue, saved in the local results file
+    ui = "http://192.168.1.10:5001"
+    assert ingest_url({"enabled": True, "url": ui}) == f"{ui}/ingest"
+    assert ingest_url({"url": ui, "ingest_url": "http://other/ingest"}) == (
+        "http://other/ingest"
+    )
+    with pytest.raises(ValueError):
+        ingest_url({"enabled": True})  # readings the UI would never see
+
+
+def test_stagger_offsets_are_even_and_stable():
+    users = [{"username": str(n)} for n in range(4)]
+    offsets = stagger_offsets(users, 60)
+    assert sorted(offsets.values()) == [0, 15, 30, 45]
+    assert stagger_offsets(list(reversed(users)), 60) == offsets
+
+
+def test_stagger_window_leaves_time_to_read_the_last_user():
+    assert stagger_window(600, 0.8, 60, 15) == 480
+    # at the default interval and timeout the last user starts 5 minutes before the end
+    assert stagger_window(600, 0.8, 300, 15) == 285
+    assert stagger_window(300, 0.8, 300, 15) == 0
+
+
+def test_cycle_staggers_users():
+    started = {}
+
+    def reader(user):
+        started[user["username"]] = time.monotonic()
+        return (True, {user["username"]: None})
+
+    users = [{"username": str(n)} for n in range(3)]
+    start = time.monotonic()
+    run_cycle(users, reader, concurrency=3, stagger=0.3)
+    delays = sorted(t - start for t in started.values())
+    assert delays[0] < 0.05
+    assert 0.1 <= delays[1] < 0.2 and 0.2 <= delays[2] < 0.3
+
+
+def test_cycle_returns_before_the_next_interval():
+    def reader(user):
+        time.sleep(0.3)
+        return (True, {user["username"]: None})
+
+    interval = 0.5
+    users = [{"username": str(n)} for n in range(4)]
+    start = time.monotonic()
+    results = run_cycle(
+        users, reader, concurrency=1, deadline=cycle_deadline(interval, 0.1)
+    )
+    # the next scheduled run isn't skipped, the carried over users wait one interval
+    assert time.monotonic() - start < interval
+    assert results[0][0] is True
+    assert [
+        r[1][u["username"]].timings.outcome for r, u in zip(results[1:], users[1:])
+    ] == ["timeout", "carried_over", "carried_over"]
+    assert cycle_deadline(60, 90) == 0
+
+
+def test_interval_start():
+    now = datetime.datetime(2020, 7, 27, 19, 37, 12)
+    assert interval_start(10, now) == datetime.datetime(2020, 7, 27, 19, 30)
+
+
+def timed_results(outcome, seconds, n=4, rss=None):
+    results = []
+    for dni in map(str, range(n)):
+        timings = ReadTimings(dni, outcome=outcome, phases={"lectura": seconds})
+        if rss:
+            timings.gauges["rss_mb"] = rss
+        results.append((outcome == "ok", {dni: SingleReadData(None, 0, 0, 0, timings)}))
+    return results
+
+
+def test_concurrency_controller_aimd():
+    controller = ConcurrencyController(
+        current=4, min_workers=1, max_workers=6, target_latency=10
+    )
+    assert controller.update(timed_results("ok", 5)) == 5
+    assert controller.update(timed_results("ok", 5)) == 6
+    assert controller.update(timed_results("ok", 5)) == 6
+    assert controller.update(timed_results("ok", 20)) == 3  # too slow
+    assert controller.update(timed_results("failed", 1)) == 1  # popup errors
+    assert controller.update(timed_results("failed", 1)) == 1
+    assert controller.update([]) == 1
+    controller.current = 4
+    # a slow portal times out, it doesn't look like instant readings
+    assert controller.update(timed_results("timeout", 20)) == 2
+    not_read = [failed_result({"username": str(n)}, "carried_over") for n in range(4)]
+    assert controller.update(not_read) == 2
+
+
+def test_concurrency_controller_memory_limit():
+    controller = ConcurrencyController(current=8, max_workers=8, reserve_mb=0)
+    controller.update(timed_results("ok", 1, rss=10 ** 9))
+    assert controller.reader_mb == 10 ** 9
+    assert controller.next() == 1  # nothing fits, still reads at min
+    assert controller.current == 1  # grows from the concurrency actually used
+    controller.reader_mb = 1
+    assert controller.update(timed_results("ok", 1)) == 2
+    assert controller.next() == 2
+
+
+def reading(dni, minute, power=0.5):
+    date = datetime.datetime(2020, 7, 27, 19, minute)
+    return (True, {dni: SingleReadData(date, power, 10.0, 3.3)})
+
+
+def test_results_log_append_and_read(tmp_path):
+    log = ResultsLog(tmp_path)
+    assert (
+        log.append([reading("a", 0), reading("b", 0), failed_result({"username": "c"})])
+        == 2
+    )
+    log.append([reading("a", 10, power=0.7)])
+    with open(log.current, "a") as f:
+        f.write('{"dni": "a", "read": ["27-07')  # cut by a power loss
+    assert [r.power for _, r in log.read("a")] == [0.5, 0.7]
+    assert [dni for dni, _ in log.read()] == ["a", "b", "a"]
+    # only the cut line is lost, not the next reading
+    log.append([reading("a", 20, power=0.9)])
+    assert [r.power for _, r in log.read("a")] == [0.5, 0.7, 0.9]
+
+
+def test_results_log_rotation(tmp_path):
+    log = ResultsLog(tmp_path, max_mb=100 / 1024 / 1024)
+    for minute in range(4):
+        log.append([reading("a", minute)])
+    segments = log.segments()
+    assert len(segments) > 1 and segments[0].suffix == ".gz"
+    assert [r.date.minute for _, r in log.read()] == [0, 1, 2, 3]
+    # rotated by age, the first reading is older than max_days
+    log = ResultsLog(tmp_path / "old", max_days=1, compress=False)
+    log.append([reading("a", 0)])
+    log.append([reading("a", 1)])
+    assert [s.name.endswith(".jsonl") for s in log.segments()] == [True, True]
+
+
+def test_circuit_breaker_trips_and_probes():
+    breaker = CircuitBreaker(window=4, min_calls=4, failure_rate=0.5, cooldown=0.05)
+    for succeed in (True, False, True, False):
+        assert breaker.allow()
+        breaker.record(succeed)
+    assert breaker.state == OPEN and not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.allow() and breaker.state == HALF_OPEN
+    assert not breaker.allow()  # a single probe at a time
+    breaker.record(False)
+    assert breaker.state == OPEN and breaker.retry_after() > 0.05  # doubled
+    time.sleep(0.11)
+    assert breaker.allow()
+    breaker.record(True)
+    assert breaker.state == CLOSED and breaker.allow()
+
+
+def test_cycle_skips_users_while_portal_is_down():
+    calls = []
+
+    def reader(user):
+        calls.append(user["username"])
+        return failed_result(user, "failed")
+
+    breaker = CircuitBreaker(window=2, min_calls=2, cooldown=60)
+    users = [{"username": str(n)} for n in range(6)]
+    results = run_cycle(
+        users, reader, concurrency=1, retries=0, breaker=breaker, delay=False
+    )
+    assert calls == ["0", "1"]
+    assert [r[1][u["username"]].timings.outcome for r, u in zip(results, users)] == [
+        "failed",
+        "failed",
+    ] + ["skipped"] * 4
+
+
+def test_cycle_counts_each_user_once_in_the_breaker():
+    calls = []
+
+    def reader(user):
+        calls.append(user["username"])
+        if user["username"] == "wrong_password":
+            return failed_result(user, "failed")
+        return (True, {user["username"]: None})
+
+    breaker = CircuitBreaker(window=4, min_calls=3, failure_rate=0.5, cooldown=60)
+    users = [{"username": "wrong_password"}, {"username": "a"}, {"username": "b"}]
+    run_cycle(
+        users,
+        reader,
+        concurrency=1,
+        retries=3,
+        backoff=0.01,
+        breaker=breaker,
+        delay=False,
+    )
+    # 4 failed attempts of the same user, but a single failed user out of three
+    assert calls.count("wrong_password") == 4
+    assert breaker.state == CLOSED
+
+
+def test_cycle_delays_users_until_probe_succeeds():
+    calls = []
+
+    def reader(user):
+        calls.append(user["username"])
+        if len(calls) <= 2:
+            return failed_result(user, "failed")
+        return (True, {user["username"]: None})
+
+    breaker = CircuitBreaker(window=2, min_calls=2, cooldown=0.05)
+    users = [{"username": str(n)} for n in range(4)]
+    results = run_cycle(
+        users, reader, concurrency=1, retries=0, breaker=breaker, deadline=5
+    )
+    assert [succeed for succeed, _ in results] == [False, False, True, True]
+
+
+def test_stopped_cycles_cancel_their_readings():
+    async def reader(user):
+        await asyncio.sleep(10)
+
+    users = [{"username": str(n)} for n in range(3)]
+    results = []
+    thread = threading.Thread(
+        target=lambda: results.extend(run_cycle(users, reader, concurrency=2))
+    )
+    start = time.monotonic()
+    thread.start()
+    time.sleep(0.1)
+    cancel_cycles()
+    thread.join(2)
+    assert time.monotonic() - start < 1
+    assert [r[1][u["username"]].timings.outcome for r, u in zip(results, users)] == [
+        "cancelled"
+    ] * 3
+
+
+def test_cycle_carries_over_users_not_started():
+    def reader(user):
+        time.sleep(0.1)
+        return (True, {user["username"]: None})
+
+    users = [{"username": str(n)} for n in range(4)]
+    results = run_cycle(users, reader, concurrency=1, retries=0, deadline=0.25)
+    assert [succeed for succeed, _ in results] == [True, True, False, False]
+    assert results[2][1]["2"].timings.outcome == "timeout"  # started, but too late
+    assert results[3][1]["3"].timings.outcome == "carried_over"
+
+
+def test_cycle_planner_carries_over_and_lengthens_interval():
+    planner = CyclePlanner(1, auto=True)
+    users = [{"username": str(n)} for n in range(3)]
+    results = [
+        timed_results("ok", 100, n=1)[0],
+        failed_result(users[1], "carried_over"),
+        failed_result(users[2], "carried_over"),
+    ]
+    report = planner.finish(users, results, datetime.datetime.now(), concurrency=1)
+    assert report.carried == 2 and report.cause == "too_many_users"
+    assert planner.effective == 2  # 100s of readings plus headroom
+    ordered, priority = planner.users(users)
+    assert priority == ["1", "2"]
+    assert [u["username"] for u in ordered] == ["1", "2", "0"]
+    report = planner.finish(users, timed_results("ok", 1, n=3), report.started, 1)
+    assert report.cause is None and planner.effective == 1
+
+
+def test_metrics_record_cycle(tmp_path):
+    path = tmp_path / "metrics.db"
+    planner = CyclePlanner(10)
+    users = [{"username": "1"}]
+    report = planner.finish(
+        users, [failed_result(users[0], "skipped")], datetime.datetime.now(), 1
+    )
+    assert report.cause is None  # failed, but within the interval
+    report.cause = "portal_down"
+    metrics.record_cycle(report, path)
+    assert metrics.summary(path=path)["overruns"] == {"portal_down": 1}
+
+
+def test_cycle_streams_results_as_they_complete():
+    def reader(user):
+        time.sleep(float(user["username"]))
+        return (True, {user["username"]: None})
+
+    written, threads = [], set()
+
+    def write(result):
+        threads.add(threading.get_ident())
+        written.append((list(result[1])[0], time.monotonic() - start))
+
+    users = [{"username": name} for name in ("0.2", "0.0", "0.1")]
+    start = time.monotonic()
+    with ResultWriter(write) as writer:
+        results = run_cycle(users, reader, on_result=writer.put)
+    assert [dni for dni, _ in written] == ["0.0", "0.1", "0.2"]
+    # the fast users were written while the slow one was still reading
+    assert written[0][1] < 0.1 and written[1][1] < 0.2
+    assert [list(values)[0] for _, values in results] == ["0.2", "0.0", "0.1"]
+    assert len(threads) == 1 and threading.get_ident() not in threads
@@ -0,0 +1,256 @@
+"""Durable queue of users to read, shared by several worker processes or hosts.
+
+The scheduler enqueues all the users once per cycle and every worker claims a few of
+them at a time with a lease. If a worker dies, its users are claimed again by another
+one when the lease expires.
+
+Workers with access to the database file use `WorkQueue`, the ones on other hosts can use
+`RemoteQueue`, which talks to the `/queue/*` endpoints of the UI application.
+
+Usage:
+    python auto_run.py queue   # enqueue the users every cycle
+    python auto_run.py worker  # claim users and read them, as many as needed
+"""
+
+import datetime
+import os
+import socket
+import sqlite3
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List
+
+import requests
+
+from scrapper import contador
+
+# the UI endpoints used by the workers only answer with the `"token"` of the config
+TOKEN_HEADER = "X-Queue-Token"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS work_items (
+    dni TEXT PRIMARY KEY,
+    password TEXT NOT NULL,
+    cycle TEXT NOT NULL,
+    state TEXT NOT NULL,
+    worker TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_work_items_state ON work_items (state, lease_until);
+"""
+
+PENDING, CLAIMED, DONE, FAILED = "pending", "claimed", "done", "failed"
+
+
+def worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+@dataclass
+class WorkQueue:
+    """SQLite backed queue, one row per user with the state of its last cycle."""
+
+    path: Path
+    lease: float = 600
+    max_attempts: int = 3
+
+    def connect(self) -> sqlite3.Connection:
+        # autocommit mode, transactions are opened explicitly with BEGIN IMMEDIATE
+        conn = sqlite3.connect(str(self.path), timeout=30, isolation_level=None)
+        conn.executescript(SCHEMA)
+        return conn
+
+    def enqueue(self, users: List[dict], cycle: str):
+        """Add the users of a new cycle. Users still claimed with a valid lease are kept."""
+        now = time.time()
+        conn = self.connect()
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany(
+            """
+            INSERT INTO work_items (dni, password, cycle, state, attempts, updated)
+            VALUES (?, ?, ?, 'pending', 0, ?)
+            ON CONFLICT (dni) DO UPDATE SET
+                password = excluded.password,
+                cycle = excluded.cycle,
+                state = 'pending',
+                attempts = 0,
+                updated = excluded.updated
+            WHERE work_items.state != 'claimed' OR work_items.lease_until < ?
+            """,
+            [(user["username"], user["password"], cycle, now, now) for user in users],
+        )
+        conn.execute("COMMIT")
+        conn.close()
+
+    def claim(self, worker: str, n: int) -> List[dict]:
+        """Lease up to `n` users to a worker, pending ones or with an expired lease."""
+        now = time.time()
+        conn = self.connect()
+        conn.execute("BEGIN IMMEDIATE")
+        # users whose workers died too many times are given up for this cycle
+        conn.execute(
+            "UPDATE work_items SET state = 'failed', updated = ? "
+            "WHERE state = 'claimed' AND lease_until < ? AND attempts >= ?",
+            (now, now, self.max_attempts),
+        )
+        rows = conn.execute(
+            "SELECT dni, password FROM work_items "
+            "WHERE state = 'pending' OR (state = 'claimed' AND lease_until < ?) "
+            "ORDER BY attempts, updated LIMIT ?",
+            (now, n),
+        ).fetchall()
+        conn.executemany(
+            "UPDATE work_items SET state = 'claimed', worker = ?, lease_until = ?, "
+            "attempts = attempts + 1, updated = ? WHERE dni = ?",
+            [(worker, now + self.lease, now, dni) for dni, _ in rows],
+        )
+        conn.execute("COMMIT")
+        conn.close()
+        return [{"username": dni, "password": password} for dni, password in rows]
+
+    def complete(self, worker: str, dni: str, succeed: bool):
+        """Close a claimed user. Ignored if the lease was lost to another worker."""
+        conn = self.connect()
+        conn.execute(
+            "UPDATE work_items SET state = ?, updated = ? "
+            "WHERE dni = ? AND worker = ? AND state = 'claimed'",
+            (DONE if succeed else FAILED, time.time(), dni, worker),
+        )
+        conn.close()
+
+    def status(self) -> dict:
+        """Number of users on each state."""
+        conn = self.connect()
+        rows = conn.execute("SELECT state, COUNT(*) FROM work_items GROUP BY state")
+        status = dict(rows.fetchall())
+        conn.close()
+        return status
+
+
+@dataclass
+class RemoteQueue:
+    """Same interface than `WorkQueue` through the UI application endpoints."""
+
+    url: str
+    token: str = ""
+    timeout: float = 30
+
+    def claim(self, worker: str, n: int) -> List[dict]:
+        resp = requests.post(
+            f"{self.url}/queue/claim",
+            json={"worker": worker, "n": n},
+            headers={TOKEN_HEADER: self.token},
+            timeout=self.timeout,
+        )
+        resp.raise_for_status()
+        return resp.json()["users"]
+
+    def complete(self, worker: str, dni: str, succeed: bool):
+        resp = requests.post(
+            f"{self.url}/queue/complete",
+            json={"worker": worker, "dni": dni, "succeed": succeed},
+            headers={TOKEN_HEADER: self.token},
+            timeout=self.timeout,
+        )
+        resp.raise_for_status()
+
+
+def local_queue(cfg: dict = None) -> WorkQueue:
+    """Queue database set in the config file."""
+    if cfg is None:
+        cfg = contador.get_config().get("queue", {})
+    return WorkQueue(
+        contador.base_path / cfg.get("path", "queue.db"),
+        lease=cfg.get("lease", 600),
+        max_attempts=cfg.get("max_attempts", 3),
+    )
+
+
+def get_queue(cfg: dict = None):
+    """Queue used by the workers, remote when the config has an `url`."""
+    if cfg is None:
+        cfg = contador.get_config().get("queue", {})
+    if cfg.get("url"):
+        return RemoteQueue(cfg["url"], token=cfg.get("token", ""))
+    return local_queue(cfg)
+
+
+def enqueue_cycle(users: List[dict] = None):
+    """Add all the users for a new reading cycle."""
+    if not users:
+        users = contador.storage("users")["usuarios"]
+    local_queue().enqueue(users, str(datetime.datetime.now()))
+    contador.info_log.info(f"{len(users)} usuarios en cola")
+
+
+def ingest_url(cfg: dict) -> str:
+    """Where the workers send the readings, the `/ingest` of `"url"` by default.
+
+    Empty to save them in the local results file, which the UI doesn't read, so it's an
+    error when the UI fills the queue (`"enabled"`).
+    """
+    url = cfg.get("ingest_url") or (f"{cfg['url']}/ingest" if cfg.get("url") else "")
+    if not url and cfg.get("enabled", False):
+        raise ValueError(
+            "La aplicación llena la cola: indica su dirección en \"url\" o su "
+            "endpoint /ingest en \"ingest_url\" para guardar las lecturas"
+        )
+    return url
+
+
+def send_results(url: str, results: list, token: str = "", timeout: float = 30):
+    """Send the readings of a batch to the UI application `/ingest` endpoint."""
+    payload = [
+        [succeed, {dni: read.to_tuple(True) for dni, read in values.items()}]
+        for succeed, values in results
+    ]
+    resp = requests.post(
+        url,
+        json={"results": payload},
+        headers={TOKEN_HEADER: token},
+        timeout=timeout,
+    )
+    resp.raise_for_status()
+
+
+def work(queue=None, worker: str = None, once: bool = False):
+    """Claim users from the queue and read them until it's empty.
+
+    Readings are saved in the local results file, or sent to `ingest_url(cfg)`. With
+    `once` the worker stops when there's nothing left to read, otherwise it waits for the
+    next cycle.
+
+    Connection errors with the UI application are logged and retried, waiting twice as
+    long each time (up to `"idle"` seconds). The users of a batch not sent are read again
+    when their lease expires.
+    """
+    cfg = contador.get_config().get("queue", {})
+    url = ingest_url(cfg)
+    queue = queue or get_queue(cfg)
+    worker = worker or worker_id()
+    idle = cfg.get("idle", 30)
+    backoff = 1
+    while True:
+        try:
+            users = queue.claim(worker, cfg.get("batch", 4))
+            if not users:
+                if once:
+                    return
+                time.sleep(idle)
+                continue
+            contador.info_log.info(f"[{worker}] {len(users)} usuarios reclamados")
+            # the batch is already a slice of the cycle, read it straight away
+            results = contador.read_multiple(users, save=not url, cycle=False)
+            if url:
+                send_results(url, results, cfg.get("token", ""))
+            # only once saved, a crash before this point leaves them to another worker
+            for user, (succeed, _) in zip(users, results):
+                queue.complete(worker, user["username"], succeed)
+            backoff = 1
+        except requests.RequestException as e:
+            contador.info_log.error(f"[{worker}] Error con la aplicación {e!r}")
+            time.sleep(backoff)
+            backoff = min(backoff * 2, idle)
@@ -2,6 +2,7 @@
 
 from ui.app import app, db, start_scheduler, start_reads, get_contador_status  # noqa
 from ui.models import User, Read, db_add_user  # noqa
+from ui.migrations import migrate
 
 
 def was_running():
@@ -19,6 +20,7 @@ def was_running():
 
 
 db.create_all()
+migrate()
 if __name__ == "__main__":
     was_running()
     app.run(debug=app.config["DEBUG_MODE"], host="0.0.0.0", port=app.config["PORT"])
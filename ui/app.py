@@ -1,11 +1,13 @@
 import csv
 import datetime
+import functools
+import hmac
 import json
 import logging
 import socket
+import sqlite3
 import tempfile
 from io import StringIO
-from multiprocessing.pool import ThreadPool
 from pathlib import Path
 
 from apscheduler.jobstores.base import ConflictingIdError  # type: ignore
@@ -14,7 +16,9 @@ from apscheduler.schedulers import SchedulerAlreadyRunningError  # type: ignore
 
 from flask import (
     Flask,
+    abort,
     flash,
+    jsonify,
     redirect,
     render_template,
     request,
@@ -23,15 +27,29 @@ from flask import (
     send_file,
 )
 from flask_sqlalchemy import SQLAlchemy  # type: ignore
-
-from scrapper import run
-from scrapper.contador import get_config
+from sqlalchemy import event  # type: ignore
+from sqlalchemy.engine import Engine  # type: ignore
+from sqlalchemy.pool import QueuePool  # type: ignore
+
+from scrapper import cycles, metrics, orchestrator, run, work_queue
+from scrapper.contador import (
+    SingleReadData,
+    close_driver_pool,
+    cycle_planner,
+    get_config,
+)
 from ui.graphs import create_barchart
 
 app = Flask(__name__)
 app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///database.db"
 app.config["SECRET_KEY"] = "only_for_local_networks"
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+# keep the connections (and their page cache) open, shared by the scheduler threads
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+    "poolclass": QueuePool,
+    "pool_size": 5,
+    "connect_args": {"check_same_thread": False},
+}
 # Get server machine IP.
 app.config["MACHINE_IP"] = socket.gethostbyname(socket.gethostname())
 app.config["DEBUG_MODE"] = True
@@ -42,6 +60,7 @@ log.disabled = True
 
 db = SQLAlchemy(app)
 scheduler = BackgroundScheduler()
+cycles.watch(scheduler, "contador", cycle_planner)
 
 
 #########################
@@ -49,6 +68,51 @@ scheduler = BackgroundScheduler()
 #########################
 
 
+@event.listens_for(Engine, "connect")
+def sqlite_pragmas(dbapi_connection, connection_record):
+    """Tune every new connection.
+
+    WAL lets the UI read while the scheduler writes, and the other way around.
+    """
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cfg = get_config().get("database", {})
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    # with WAL, NORMAL only syncs on checkpoints and is still safe from corruption
+    cursor.execute(f"PRAGMA synchronous={cfg.get('synchronous', 'NORMAL')}")
+    cursor.execute(f"PRAGMA cache_size=-{cfg.get('cache_mb', 16) * 1024}")
+    cursor.execute(f"PRAGMA mmap_size={cfg.get('mmap_mb', 64) * 1024 * 1024}")
+    cursor.execute(f"PRAGMA busy_timeout={cfg.get('busy_timeout_ms', 5000)}")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+
+def db_maintenance():
+    """Move the WAL into the database file and refresh the query planner stats."""
+    with db.engine.connect() as conn:
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        conn.execute("PRAGMA optimize")
+
+
+def worker_endpoint(view):
+    """Endpoints of the queue workers, only with the `"token"` of the `"queue"` config.
+
+    They give away the passwords of the users and write readings, so without a token
+    configured they are closed.
+    """
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        token = get_config().get("queue", {}).get("token", "")
+        sent = request.headers.get(work_queue.TOKEN_HEADER, "")
+        if not token or not hmac.compare_digest(sent, token):
+            abort(403)
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
 def get_contador_status() -> bool:
     """Get contador running status."""
     with open("status.json") as f:
@@ -60,11 +124,9 @@ def start_reads():
     """Start the process of readings."""
     try:  # avoids start two jobs with same id
         update_contador_status(True)
-        pool = ThreadPool(4)
         print("Comenzando una nueva consulta")
-        scheduler.add_job(
-            **scheduler_config(sched_task, (pool,), datetime.datetime.now())
-        )
+        # first cycle on the next interval boundary
+        scheduler.add_job(**scheduler_config(sched_task, ()))
     except ConflictingIdError:
         pass
 
@@ -75,16 +137,27 @@ def update_contador_status(status: bool):
         json.dump({"running": status}, f)
 
 
-def scheduler_config(fn, args, start):
+def scheduler_config(fn, args, start=None):
     """Scheduler base configurations."""
-    return {
+    minutes = get_config()["script"]["frecuencia [minutos]"]
+    config = {
         "func": fn,
         "args": args,
         "trigger": "interval",
-        "minutes": get_config()["script"]["frecuencia [minutos]"],
-        "next_run_time": start,
+        "minutes": minutes,
+        # cycles run on wall clock multiples of the interval, so that every user keeps
+        # its stagger slot across restarts
+        "start_date": orchestrator.interval_start(minutes),
         "id": "contador",
+        # a cycle still running makes the next one be skipped (and recorded), never
+        # overlap; runs missed while busy are merged into one
+        "max_instances": 1,
+        "coalesce": True,
+        "misfire_grace_time": 60,
     }
+    if start is not None:
+        config["next_run_time"] = start
+    return config
 
 
 def _csv_writer(fname):
@@ -93,7 +166,10 @@ def _csv_writer(fname):
     Writes a csv like object to be saved later in a tempfile to be send to the user
     """
     dni = fname.split(".")[0]
-    user_records = User.all_reads(dni)
+    if User.get_by_dni(dni) is None:
+        abort(404)
+    # every reading, archived ones too, without loading them as `Read`
+    columns = timeseries.store(dni).columns()
     f = StringIO()
     csv_writer = csv.writer(f)
     csv_writer.writerow(
@@ -106,31 +182,41 @@ def _csv_writer(fname):
             "Fin de semana",
         ]
     )
-    for rec in user_records:
+    for date, power, percent, max_power in zip(
+        columns["date"].tolist(),
+        columns["consumption"].tolist(),
+        columns["percent"].tolist(),
+        columns["max_power"].tolist(),
+    ):
         csv_writer.writerow(
             [
-                rec.instantaneous_consume,
-                rec.percent,
-                rec.max_power,
-                rec.date.strftime("%D"),  # Day
-                rec.date.strftime("%T"),  # Hour
-                ("Si" if rec.weekend is True else "No"),
+                power,
+                percent,
+                max_power,
+                date.strftime("%D"),  # Day
+                date.strftime("%T"),  # Hour
+                ("Si" if date.isoweekday() > 5 else "No"),
             ]
         )
     return f
 
 
-def sched_task(pool: ThreadPool, save: bool = False):
+def sched_task(save: bool = False):
     """Schedule call to run contador script automatically on background."""
 
     users: list = User.as_list()  # will get new users automatically on every run
-    results = run.multiple(pool, users, False)
-    for res in results:
-        if res[0] is False:
-            continue
-        else:
-            # TODO: Add results to database
-            add_reads(res[1])
+    if get_config().get("queue", {}).get("enabled", False):
+        # the readings are done by the workers and sent back to /ingest
+        work_queue.local_queue().enqueue(users, str(datetime.datetime.now()))
+        return
+    run.multiple(users, False, _add_result)
+
+
+def _add_result(result):
+    """Save every reading as soon as it's done, not waiting for the slowest user."""
+    succeed, values = result
+    if succeed:  # failed ones already retried during the cycle
+        add_reads(values)
 
 
 #########################
@@ -244,9 +330,57 @@ def get_plot(dni):
 
 @app.route("/historic_stats/<dni>", methods=["GET"])
 def historic_stats(dni):
+    """Stats of all the readings, or of the ones in ?start=&end= (ISO dates)."""
     user = User.get_by_dni(dni)
-    stats = Read.historic_stats(id_=user.id)
-    return stats
+    if user is None:
+        abort(404)
+    try:
+        start, end = (
+            request.args.get(arg) and datetime.datetime.fromisoformat(request.args[arg])
+            for arg in ("start", "end")
+        )
+    except ValueError:
+        abort(400, "start y end deben ser fechas ISO, p.ej. 2020-08-03")
+    if start is None and end is None:
+        return Rollup.historic_stats(user.id)
+    # archived readings are only in the columnar store
+    return column_stats(timeseries.store(dni).columns(), start, end)
+
+
+@app.route("/metrics", methods=["GET"])
+def reading_metrics():
+    """p50/p95 seconds of every reading phase, overall and per user."""
+    return metrics.summary()
+
+
+@app.route("/ingest", methods=["POST"])
+@worker_endpoint
+def ingest_readings():
+    """Save readings done by the queue workers."""
+    readings = [
+        (dni, SingleReadData.from_tuple(read))
+        for succeed, values in request.get_json()["results"]
+        if succeed
+        for dni, read in values.items()
+    ]
+    return {"saved": ingest(readings)}
+
+
+@app.route("/queue/claim", methods=["POST"])
+@worker_endpoint
+def queue_claim():
+    """Lease users to a worker on another host."""
+    data = request.get_json()
+    users = work_queue.local_queue().claim(data["worker"], int(data["n"]))
+    return jsonify(users=users)
+
+
+@app.route("/queue/complete", methods=["POST"])
+@worker_endpoint
+def queue_complete():
+    data = request.get_json()
+    work_queue.local_queue().complete(data["worker"], data["dni"], data["succeed"])
+    return {"ok": True}
 
 
 @app.route("/render_plot")
@@ -268,7 +402,9 @@ def stop_read():
     """Stop the process of readings."""
     flash("Terminadas las consultas automaticas.", "info")
     scheduler.remove_job("contador")
+    orchestrator.cancel_cycles()  # the one running doesn't wait until its deadline
     update_contador_status(False)
+    close_driver_pool()
     return redirect(url_for("home"))
 
 
@@ -277,20 +413,38 @@ def start_scheduler():
     """Start scheduler but without any tasks."""
     try:
         print("Starting scheduler")
+        scheduler.add_job(
+            db_maintenance,
+            "interval",
+            minutes=get_config().get("database", {}).get("checkpoint_minutes", 60),
+            id="db_maintenance",
+            replace_existing=True,
+        )
+        if get_config().get("retention", {}).get("enabled", False):
+            scheduler.add_job(
+                lambda: retention.retention().apply(),
+                "interval",
+                hours=get_config()["retention"].get("check_hours", 24),
+                id="retention",
+                replace_existing=True,
+            )
         scheduler.start()
     except SchedulerAlreadyRunningError:
         pass
 
 
 from ui.models import (
-    Read,
+    Rollup,
     User,
     UserTotalStats,
     add_reads,  # noqa
+    column_stats,
     db_add_user,
     delete_user,
+    ingest,
     update_user,
 )  # noqa isort:skip
+from ui import retention, timeseries  # noqa isort:skip
 
 print(f' App URL: {app.config["MACHINE_IP"]}:{app.config["PORT"]}')
 
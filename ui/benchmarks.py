@@ -0,0 +1,163 @@
+"""Benchmark of the weekly stats of the plot.
+
+Usage:
+    python -m ui.benchmarks
+
+Synthetic 10 minutes readings of 1 and 5 years, stats computed per `Read` like object
+with `groupby` and `tee` (how `UserTotalStats` used to do it, kept here as reference)
+and vectorized with `week_stats`, which must give the same results.
+"""
+
+import datetime
+import itertools
+import time
+from itertools import groupby
+from typing import Callable, List, NamedTuple
+
+import numpy as np
+
+from ui import timeseries
+from ui.models import (
+    Timestamp,
+    calculate_max_consumption_peak,
+    is_weekend,
+    tariff_period,
+    week_stats,
+)
+
+
+class Row(NamedTuple):
+    date: datetime.datetime
+    instantaneous_consume: float
+
+    @property
+    def weekend(self) -> bool:
+        return is_weekend(self.date)
+
+
+def synthetic_rows(years: int) -> List[Row]:
+    start = datetime.datetime(2020, 1, 1)
+    rng = np.random.default_rng(0)
+    n = years * 365 * 24 * 6
+    consumption = rng.uniform(0, 5, n).round(2)
+    return [
+        Row(start + datetime.timedelta(minutes=10 * i), float(consumption[i]))
+        for i in range(n)
+    ]
+
+
+def to_columns(rows: List[Row]) -> dict:
+    return timeseries.from_rows(
+        [
+            {
+                "date": row.date,
+                "instantaneous_consume": row.instantaneous_consume,
+                "percent": 0.0,
+                "max_power": 0.0,
+                "period": tariff_period(row.date),
+            }
+            for row in rows
+        ]
+    )
+
+
+def rows_week_stats(rows: List[Row]) -> List[dict]:
+    """Reference, the per `Read` implementation `week_stats` replaced, unchanged."""
+
+    def grouper(item):
+        year, week, _ = item.date.isocalendar()
+        return Timestamp(year, week, item.date.month)
+
+    stats = []
+    for (ts, values) in groupby(rows, grouper):
+        val1, val2, val3 = itertools.tee(values, 3)
+        stats.append(
+            {
+                "year": ts.year,
+                "week": ts.week,
+                "month": ts.month,
+                "max_punta": calculate_max_consumption_peak(hora_punta(val2)),
+                "max_valle": calculate_max_consumption_peak(hora_valle(val1)),
+                "max_llana": calculate_max_consumption_peak(hora_llana(val3)),
+            }
+        )
+    return stats
+
+
+def hora_valle(gen):
+    return [
+        el
+        for el in gen
+        if (
+            (el.date.hour >= 0)
+            and (el.date.hour <= 8)
+            and ((el.weekend is True) or (el.weekend is False))
+        )
+    ]
+
+
+def hora_punta(gen):
+    lst = []
+    for el in gen:
+        if (
+            (10 <= el.date.hour and el.date.hour <= 14)
+            or (18 <= el.date.hour and el.date.hour <= 22)
+            and el.weekend is False
+        ):
+            lst.append(el)
+    return lst
+
+
+def hora_llana(gen):
+    lst2 = []
+    for el in gen:
+        if (
+            any(
+                [
+                    (8 < el.date.hour and el.date.hour < 10),
+                    (14 < el.date.hour and el.date.hour < 18),
+                    (22 < el.date.hour and el.date.hour < 24),
+                ]
+            )
+            and el.weekend is False
+        ):
+            lst2.append(el)
+    return lst2
+
+
+def to_dicts(stats) -> List[dict]:
+    return [
+        {
+            "year": s.timestamp.year,
+            "week": s.timestamp.week,
+            "month": s.timestamp.month,
+            **{f"max_{p}": getattr(s, f"max_{p}") for p in timeseries.PERIODS},
+        }
+        for s in stats
+    ]
+
+
+def best_ms(fn: Callable, repeat: int = 3) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def bench_week_stats(years: int):
+    rows = synthetic_rows(years)
+    columns = to_columns(rows)
+    assert to_dicts(week_stats(columns)) == rows_week_stats(rows)
+    rows_ms = best_ms(lambda: rows_week_stats(rows), repeat=1)
+    vector_ms = best_ms(lambda: week_stats(columns))
+    print(
+        f"{years} año(s), {len(rows)} lecturas: por fila {rows_ms:.0f} ms, "
+        f"vectorizado {vector_ms:.1f} ms ({rows_ms / vector_ms:.0f}x)"
+    )
+
+
+if __name__ == "__main__":
+    for years in (1, 5):
+        bench_week_stats(years)
@@ -0,0 +1,121 @@
+"""Schema changes for databases created before the current models.
+
+`db.create_all()` only creates missing tables, changes on existing ones are applied here,
+once, in order. Every migration is recorded in the `migrations` table.
+"""
+
+from ui import timeseries
+from ui.app import db
+
+
+def reads_unique_user_date(conn):
+    """Drop duplicated readings and make (user_id, date) unique."""
+    conn.execute(
+        "DELETE FROM reads WHERE id NOT IN "
+        "(SELECT MIN(id) FROM reads GROUP BY user_id, date)"
+    )
+    conn.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_reads_user_date ON reads (user_id, date)"
+    )
+
+
+def _add_columns(conn, table: str, columns: dict):
+    existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+    for name, type_ in columns.items():
+        if name not in existing:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {type_}")
+
+
+# same rule than `ui.models.tariff_period`, strftime('%w') is 0 on sunday
+BACKFILL_PERIOD = """
+UPDATE reads SET
+    hour = CAST(strftime('%H', date) AS INTEGER),
+    weekday = CASE strftime('%w', date) WHEN '0' THEN 7
+        ELSE CAST(strftime('%w', date) AS INTEGER) END
+WHERE hour IS NULL;
+UPDATE reads SET period = CASE
+    WHEN hour < 8 OR weekday >= 6 THEN 'valle'
+    WHEN hour BETWEEN 10 AND 13 OR hour BETWEEN 18 AND 21 THEN 'punta'
+    ELSE 'llana' END
+WHERE period IS NULL;
+"""
+
+
+def reads_tariff_period(conn):
+    """Store the tariff period, hour and weekday of every reading, indexed."""
+    _add_columns(
+        conn, "reads", {"period": "VARCHAR(5)", "hour": "INTEGER", "weekday": "INTEGER"}
+    )
+    for statement in BACKFILL_PERIOD.split(";"):
+        if statement.strip():
+            conn.execute(statement)
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS ix_reads_user_period_date "
+        "ON reads (user_id, period, date)"
+    )
+
+
+# bucket start of every grain, in the format SQLAlchemy stores the dates
+ROLLUP_STARTS = {
+    "hour": "strftime('%Y-%m-%d %H:00:00.000000', date)",
+    "day": "strftime('%Y-%m-%d 00:00:00.000000', date)",
+    "week": "date(date, '-' || (weekday - 1) || ' days') || ' 00:00:00.000000'",
+}
+
+
+def rebuild_rollups(conn):
+    """Build again the rollups of every user from the reads.
+
+    The rollups of the weeks already archived (see `ui.retention`) are kept: only the
+    ones from the week of the first reading still in the db of each user are rebuilt.
+    """
+    conn.execute(
+        "DELETE FROM rollups WHERE start >= (SELECT date(MIN(date), '-' || "
+        "((CAST(strftime('%w', MIN(date)) AS INTEGER) + 6) % 7) || ' days') "
+        "FROM reads r WHERE r.user_id = rollups.user_id)"
+    )
+    for grain, start in ROLLUP_STARTS.items():
+        conn.execute(
+            "INSERT INTO rollups (user_id, grain, start, period, count, sum, min, max) "
+            f"SELECT user_id, '{grain}', {start}, period, COUNT(*), "
+            "SUM(instantaneous_consume), MIN(instantaneous_consume), "
+            "MAX(instantaneous_consume) FROM reads "
+            "WHERE user_id IS NOT NULL AND instantaneous_consume IS NOT NULL "
+            "GROUP BY 1, 3, 4"
+        )
+    # reads may have changed without `ingest`
+    timeseries.remove_all()
+
+
+MIGRATIONS = [
+    ("reads_unique_user_date", reads_unique_user_date),
+    ("reads_tariff_period", reads_tariff_period),
+    ("rollups", rebuild_rollups),
+]
+
+
+def migrate():
+    """Apply the migrations not applied yet."""
+    with db.engine.begin() as conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS migrations (name TEXT PRIMARY KEY)")
+        done = {name for (name,) in conn.execute("SELECT name FROM migrations")}
+        for name, migration in MIGRATIONS:
+            if name in done:
+                continue
+            print(f"Aplicando migración {name}")
+            migration(conn)
+            conn.execute("INSERT INTO migrations (name) VALUES (?)", (name,))
+            # built from the reads as they were before the migration
+            timeseries.remove_all()
+
+
+if __name__ == "__main__":
+    # python -m ui.migrations rollups: rebuild the rollups from the reads
+    import sys
+
+    db.create_all()
+    migrate()
+    if sys.argv[1:] == ["rollups"]:
+        print("Reconstruyendo rollups")
+        with db.engine.begin() as conn:
+            rebuild_rollups(conn)
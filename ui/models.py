@@ -3,17 +3,21 @@
 """
 import datetime
 from itertools import groupby
-from typing import List, NamedTuple, Dict
+from typing import Dict, Iterable, List, NamedTuple, Tuple
 from dataclasses import dataclass, field
-import itertools
 import sqlite3
 
+import numpy as np
+
 from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy import extract, and_, or_
+from sqlalchemy import bindparam, extract, text
 
 from ui.app import db
 from scrapper.contador import SingleReadData
 
+# tariff periods
+PUNTA, LLANA, VALLE = "punta", "llana", "valle"
+
 
 class User(db.Model):
     """User database model."""
@@ -60,6 +64,16 @@ class Read(db.Model):
     max_power = db.Column(db.Float())
     date = db.Column(db.DateTime())
     weekend = db.Column(db.Boolean(), default=False)
+    # computed from the date on insert, see `tariff_period`
+    period = db.Column(db.String(5))
+    hour = db.Column(db.Integer())
+    weekday = db.Column(db.Integer())  # ISO, 1 monday - 7 sunday
+
+    __table_args__ = (
+        # one reading per user and date, ingesting the same one twice is a no-op
+        db.Index("ix_reads_user_date", "user_id", "date", unique=True),
+        db.Index("ix_reads_user_period_date", "user_id", "period", "date"),
+    )
 
     @hybrid_property
     def date_hour(self):
@@ -69,46 +83,6 @@ class Read(db.Model):
     def date_hour(cls):
         return extract("hour", cls.date)
 
-    @classmethod
-    def historic_stats(cls, id_):
-        """All gross comsuptions stats."""
-        user_data = cls.query.filter_by(user_id=id_).all()
-        punta = cls.get_hora_punta(id_)
-        valle = cls.get_hora_valle(id_)
-        llana = cls.get_hora_llana(id_)
-        # breakpoint()
-        # TODO: Fix ValueError when user don't have records
-        try:
-            return {
-                "max": calculate_max_consumption_peak(user_data),
-                "min": calculate_min_consumption_peak(user_data),
-                "average": calculate_average_consumption(user_data),
-                "max_punta": calculate_max_consumption_peak(punta),
-                "min_punta": calculate_min_consumption_peak(punta),
-                "average_punta": calculate_average_consumption(punta),
-                "max_valle": calculate_max_consumption_peak(valle),
-                "min_valle": calculate_min_consumption_peak(valle),
-                "average_valle": calculate_average_consumption(valle),
-                "max_llana": calculate_max_consumption_peak(llana),
-                "min_llana": calculate_min_consumption_peak(llana),
-                "average_llana": calculate_average_consumption(llana),
-            }
-        except ValueError:  # no data to be calculate max and min
-            return {
-                "max": "",
-                "min": "",
-                "average": "",
-                "max_punta": "",
-                "min_punta": "",
-                "average_punta": "",
-                "max_valle": "",
-                "min_valle": "",
-                "average_valle": "",
-                "max_llana": "",
-                "min_llana": "",
-                "average_llana": "",
-            }
-
     @classmethod
     def stats_by_week(cls, id_):
         """TODO: Stats to be pass into create_plot."""
@@ -123,48 +97,220 @@ class Read(db.Model):
             for ((year, week, month), data) in groupby(query, grouper)
         ]
 
+    @classmethod
+    def get_period(cls, id_: int, period: str) -> List[object]:
+        """Reads of a user in a tariff period, an index range scan."""
+        return cls.query.filter(cls.user_id == id_, cls.period == period).all()
+
     @classmethod
     def get_hora_punta(cls, id_: int) -> List[object]:
         """Filter by hora punta.
 
-        10 - 14 and 18 - 22
+        10 - 14 and 18 - 22, weekdays
         """
-        return Read.query.filter(
-            Read.user_id == id_,
-            Read.weekend == False,  # noqa
-            or_(
-                and_(Read.date_hour >= 10, Read.date_hour <= 14),
-                and_(Read.date_hour >= 18, Read.date_hour <= 22),
-            ),
-        ).all()
+        return cls.get_period(id_, PUNTA)
 
     @classmethod
     def get_hora_llana(cls, id_: int) -> List[object]:
         """Filter by hora llana.
 
-        8 - 10, 14 - 18, 22 - 24
+        8 - 10, 14 - 18, 22 - 24, weekdays
         """
-        return Read.query.filter(
-            Read.user_id == id_,
-            Read.weekend == False,  # noqa
-            or_(
-                and_(Read.date_hour >= 8, Read.date_hour <= 10),
-                and_(Read.date_hour >= 14, Read.date_hour <= 18),
-                and_(Read.date_hour >= 22, Read.date_hour <= 24),
-            ),
-        ).all()
+        return cls.get_period(id_, LLANA)
 
     @classmethod
     def get_hora_valle(cls, id_: int) -> List[object]:
         """Filter by hora valle.
 
-        0 - 8
+        0 - 8, and all day on weekends
         """
-        return Read.query.filter(
-            Read.user_id == id_,
-            or_(Read.weekend == False, Read.weekend == True),  # noqa
-            and_(Read.date_hour >= 0, Read.date_hour <= 8),
-        ).all()
+        return cls.get_period(id_, VALLE)
+
+
+@db.event.listens_for(Read, "before_insert")
+def _set_period(mapper, connection, read):
+    """Reads added through the ORM get the same computed columns than `ingest`."""
+    if read.date is not None and read.period is None:
+        read.period = tariff_period(read.date)
+        read.hour = read.date.hour
+        read.weekday = read.date.isoweekday()
+
+
+@db.event.listens_for(Read, "after_insert")
+def _add_to_rollups(mapper, connection, read):
+    """Reads added through the ORM count in the rollups and cached weeks, as the ones
+    saved by `ingest` (which doesn't go through the ORM, so it isn't counted twice)."""
+    if read.date is None or read.instantaneous_consume is None:
+        return
+    row = {
+        "user_id": read.user_id,
+        "date": read.date,
+        "period": read.period,
+        "instantaneous_consume": read.instantaneous_consume,
+    }
+    connection.execute(UPSERT_ROLLUP, rollup_rows([row]))
+    _invalidate_weeks([row], connection)
+
+
+class Rollup(db.Model):
+    """Consumption of a user per hour, day or ISO week and tariff period.
+
+    Kept up to date by `ingest` and when reads are added through the ORM,
+    `ui.migrations.rebuild_rollups` builds them again from the reads.
+    """
+
+    __tablename__ = "rollups"
+    user_id = db.Column(db.Integer(), db.ForeignKey("users.id"), primary_key=True)
+    grain = db.Column(db.String(4), primary_key=True)  # hour, day or week
+    start = db.Column(db.DateTime(), primary_key=True)
+    period = db.Column(db.String(5), primary_key=True)
+    count = db.Column(db.Integer(), nullable=False)
+    sum = db.Column(db.Float(), nullable=False)
+    min = db.Column(db.Float(), nullable=False)
+    max = db.Column(db.Float(), nullable=False)
+
+    @classmethod
+    def historic_stats(cls, id_: int) -> dict:
+        """All gross consumption stats (max, min and average, overall and per tariff
+        period), from the weekly rollups. Stats of periods without reads are None."""
+        rows = (
+            db.session.query(
+                cls.period,
+                db.func.sum(cls.count),
+                db.func.sum(cls.sum),
+                db.func.min(cls.min),
+                db.func.max(cls.max),
+            )
+            .filter(cls.user_id == id_, cls.grain == "week")
+            .group_by(cls.period)
+            .all()
+        )
+        if not rows:
+            return {key: None for key in _stats_keys()}
+        periods = {period: values for period, *values in rows}
+        periods[None] = [
+            sum(row[1] for row in rows),
+            sum(row[2] for row in rows),
+            min(row[3] for row in rows),
+            max(row[4] for row in rows),
+        ]
+        stats = {}
+        for period in (None, PUNTA, VALLE, LLANA):
+            suffix = f"_{period}" if period else ""
+            count, total, min_, max_ = periods.get(period, (0, None, None, None))
+            stats[f"max{suffix}"] = _round(max_)
+            stats[f"min{suffix}"] = _round(min_)
+            stats[f"average{suffix}"] = _round(total / count) if count else None
+        return stats
+
+    @classmethod
+    def weekly_max(cls, id_: int) -> List[dict]:
+        """Max consumption per tariff period, grouped like `UserTotalStats.to_dict`: by
+        week, split when the week spans two months."""
+        rows = (
+            cls.query.filter_by(user_id=id_, grain="day")
+            .order_by(cls.start)
+            .with_entities(cls.start, cls.period, cls.max)
+            .all()
+        )
+
+        def grouper(row):
+            year, week, _ = row.start.isocalendar()
+            return Timestamp(year, week, row.start.month)
+
+        weeks = []
+        for ts, values in groupby(rows, grouper):
+            week = {"year": ts.year, "week": ts.week, "month": ts.month}
+            week.update({f"max_{p}": None for p in (PUNTA, VALLE, LLANA)})
+            for row in values:
+                key = f"max_{row.period}"
+                week[key] = row.max if week[key] is None else max(week[key], row.max)
+            for p in (PUNTA, VALLE, LLANA):
+                week[f"max_{p}"] = _round(week[f"max_{p}"])
+            weeks.append(week)
+        return weeks
+
+
+def column_stats(
+    columns: Dict[str, np.ndarray],
+    start: datetime.datetime = None,
+    end: datetime.datetime = None,
+) -> dict:
+    """Same stats than `Rollup.historic_stats`, of the `ui.timeseries` columns of a user
+    in [start, end). These include the readings already archived."""
+    dates = columns["date"]
+    first = 0 if start is None else np.searchsorted(dates, np.datetime64(start))
+    last = len(dates) if end is None else np.searchsorted(dates, np.datetime64(end))
+    consumption = columns["consumption"][first:last]
+    periods = columns["period"][first:last]
+    figures = []
+    for period in (None, PUNTA, VALLE, LLANA):
+        values = consumption
+        if period is not None:
+            values = consumption[periods == timeseries.PERIODS.index(period)]
+        if not len(values):
+            figures += [None] * 3
+            continue
+        figures += [float(values.max()), float(values.min()), float(values.mean())]
+    return dict(zip(_stats_keys(), map(_round, figures)))
+
+
+def _stats_keys():
+    return [
+        f"{stat}{suffix}"
+        for suffix in ("", "_punta", "_valle", "_llana")
+        for stat in ("max", "min", "average")
+    ]
+
+
+def _round(value):
+    return None if value is None else round(value, 2)
+
+
+ROLLUP_GRAINS = {
+    "hour": lambda dt: dt.replace(minute=0, second=0, microsecond=0),
+    "day": lambda dt: dt.replace(hour=0, minute=0, second=0, microsecond=0),
+    "week": lambda dt: (
+        dt.replace(hour=0, minute=0, second=0, microsecond=0)
+        - datetime.timedelta(days=dt.isoweekday() - 1)
+    ),
+}
+
+UPSERT_ROLLUP = text(
+    """
+    INSERT INTO rollups (user_id, grain, start, period, count, sum, min, max)
+    VALUES (:user_id, :grain, :start, :period, :count, :sum, :min, :max)
+    ON CONFLICT (user_id, grain, start, period) DO UPDATE SET
+        count = count + excluded.count,
+        sum = sum + excluded.sum,
+        min = MIN(min, excluded.min),
+        max = MAX(max, excluded.max)
+    """
+).bindparams(bindparam("start", type_=db.DateTime()))
+
+
+def rollup_rows(reads: List[dict]) -> List[dict]:
+    """Rollup increments of new reads, as `ingest` rows."""
+    buckets: Dict[tuple, dict] = {}
+    for read in reads:
+        power = read["instantaneous_consume"]
+        for grain, start in ROLLUP_GRAINS.items():
+            key = (read["user_id"], grain, start(read["date"]), read["period"])
+            bucket = buckets.get(key)
+            if bucket is None:
+                buckets[key] = dict(
+                    zip(("user_id", "grain", "start", "period"), key),
+                    count=1,
+                    sum=power,
+                    min=power,
+                    max=power,
+                )
+                continue
+            bucket["count"] += 1
+            bucket["sum"] += power
+            bucket["min"] = min(bucket["min"], power)
+            bucket["max"] = max(bucket["max"], power)
+    return list(buckets.values())
 
 
 # @dataclass
@@ -190,12 +336,62 @@ class WeekStats:
     """Weekly reads stats."""
 
     timestamp: Timestamp
-    values: itertools._grouper
+    values: Dict[str, np.ndarray]  # `ui.timeseries` columns of the week
     max_punta: float = 0.0
     max_valle: float = 0.0
     max_llana: float = 0.0
 
 
+class CachedWeek(db.Model):
+    """`WeekStats` of a closed week, see `UserTotalStats.stats_by_week`.
+
+    `ingest` and ORM inserts drop the weeks they add readings to, and the ones after
+    them.
+    """
+
+    __tablename__ = "week_stats"
+    user_id = db.Column(db.Integer(), db.ForeignKey("users.id"), primary_key=True)
+    year = db.Column(db.Integer(), primary_key=True)  # ISO year and week
+    week = db.Column(db.Integer(), primary_key=True)
+    month = db.Column(db.Integer(), primary_key=True)
+    max_punta = db.Column(db.Float())
+    max_valle = db.Column(db.Float())
+    max_llana = db.Column(db.Float())
+
+    @staticmethod
+    def row(user_id: int, stats: WeekStats) -> dict:
+        return {
+            "user_id": user_id,
+            **stats.timestamp._asdict(),
+            "max_punta": stats.max_punta,
+            "max_valle": stats.max_valle,
+            "max_llana": stats.max_llana,
+        }
+
+    def monday(self) -> datetime.datetime:
+        return datetime.datetime.strptime(f"{self.year}-W{self.week}-1", "%G-W%V-%u")
+
+    def days(self) -> List[datetime.datetime]:
+        """Days of the week in its month, a week spanning two months is cached twice."""
+        days = [self.monday() + datetime.timedelta(days=n) for n in range(7)]
+        return [day for day in days if day.month == self.month]
+
+    def stats(self, columns: Dict[str, np.ndarray]) -> WeekStats:
+        """The cached stats, with the columns of the days of the week in its month."""
+        days = self.days()
+        start, end = np.searchsorted(
+            columns["date"],
+            [np.datetime64(days[0]), np.datetime64(days[-1] + datetime.timedelta(1))],
+        )
+        return WeekStats(
+            Timestamp(self.year, self.week, self.month),
+            values={name: values[start:end] for name, values in columns.items()},
+            max_punta=self.max_punta,
+            max_valle=self.max_valle,
+            max_llana=self.max_llana,
+        )
+
+
 @dataclass
 class UserTotalStats:
     """User historic statistics."""
@@ -217,75 +413,94 @@ class UserTotalStats:
         ]
 
     def stats_by_week(self) -> List[WeekStats]:
-        """TODO: Stats to be pass into create_plot."""
+        """Stats to be pass into create_plot, from the columnar store of the user.
 
-        def grouper(item):
-            year, week, _ = item.date.isocalendar()
-            return Timestamp(year, week, item.date.month)
-
-        data = self.user.reads.all()
-        ts: Timestamp
-        for (ts, values) in groupby(data, grouper):
-            val1, val2, val3 = itertools.tee(values, 3)
-            max_valle = calculate_max_consumption_peak(self.hora_valle(val1))
-            max_punta = calculate_max_consumption_peak(self.hora_punta(val2))
-            max_llana = calculate_max_consumption_peak(self.hora_llana(val3))
-            self.stats.append(
-                WeekStats(
-                    ts,
-                    values=values,
-                    max_valle=max_valle,
-                    max_punta=max_punta,
-                    max_llana=max_llana,
-                )
+        Closed weeks come from the `week_stats` cache, only the weeks after the cached
+        ones are computed, and all of them but the last one are cached.
+        """
+        columns = timeseries.store(self.user.dni).columns()
+        cached = sorted(
+            CachedWeek.query.filter_by(user_id=self.user.id).all(),
+            # by date, the december part of a week goes before the january one
+            key=lambda week: week.days()[0],
+        )
+        first = 0
+        if cached:
+            end = cached[-1].monday() + datetime.timedelta(days=7)
+            first = int(np.searchsorted(columns["date"], np.datetime64(end)))
+        new = week_stats({name: values[first:] for name, values in columns.items()})
+        last = new[-1].timestamp[:2] if new else None
+        closed = [week for week in new if week.timestamp[:2] != last]
+        if closed:
+            db.session.execute(
+                CachedWeek.__table__.insert().prefix_with("OR REPLACE"),
+                [CachedWeek.row(self.user.id, week) for week in closed],
             )
+            db.session.commit()
+        self.stats = [week.stats(columns) for week in cached] + new
         return self.stats
 
-    def hora_valle(self, gen):
-        return [
-            el
-            for el in gen
-            if (
-                (el.date.hour >= 0)
-                and (el.date.hour <= 8)
-                and ((el.weekend is True) or (el.weekend is False))
-            )
-        ]
-
-    def hora_punta(self, gen):
-        lst = []
-        for el in gen:
-            if (
-                (10 <= el.date.hour and el.date.hour <= 14)
-                or (18 <= el.date.hour and el.date.hour <= 22)
-                and el.weekend is False
-            ):
-                lst.append(el)
-        return lst
-
-    def hora_llana(self, gen):
-        # breakpoint()
-        lst2 = []
-        for el in gen:
-            if (
-                any(
-                    [
-                        (8 < el.date.hour and el.date.hour < 10),
-                        (14 < el.date.hour and el.date.hour < 18),
-                        (22 < el.date.hour and el.date.hour < 24),
-                    ]
-                )
-                and el.weekend is False
-            ):
-                # if not el.weekend:
-                lst2.append(el)
-
-        return lst2
-
     def get_stats(self):
         return self.stats_by_week()
 
 
+def iso_weeks(dates: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """ISO year and week of every date, as `date.isocalendar()`."""
+    days = dates.astype("datetime64[D]")
+    weekday = (days.astype(np.int64) + 3) % 7  # 1970-01-01 was thursday, monday is 0
+    # the ISO year of a week is the year of its thursday
+    thursday = days - weekday + 3
+    year_start = thursday.astype("datetime64[Y]")
+    week = (thursday - year_start.astype("datetime64[D]")).astype(np.int64) // 7 + 1
+    return year_start.astype(np.int64) + 1970, week
+
+
+def plot_periods(dates: np.ndarray) -> Dict[str, np.ndarray]:
+    """Readings of every period in the weekly plot, as it has always classified them.
+
+    Not `tariff_period`: valle is 0 - 8 every day, punta 10 - 14 every day and 18 - 22
+    on weekdays, llana 9, 15 - 17 and 23 on weekdays. Hours 8, 14 and 22 are included.
+    """
+    days = dates.astype("datetime64[D]")
+    hour = (dates - days).astype("timedelta64[h]").astype(np.int64)
+    weekday = ~((days.astype(np.int64) + 3) % 7 >= 5)
+    return {
+        PUNTA: ((10 <= hour) & (hour <= 14)) | ((18 <= hour) & (hour <= 22) & weekday),
+        VALLE: hour <= 8,
+        LLANA: ((hour == 9) | ((15 <= hour) & (hour <= 17)) | (hour == 23)) & weekday,
+    }
+
+
+def week_stats(columns: Dict[str, np.ndarray]) -> List[WeekStats]:
+    """Max consumption per tariff period of every week, split when the week spans two
+    months. The columns must be sorted by date, as `ui.timeseries` stores them."""
+    dates = columns["date"]
+    if not len(dates):
+        return []
+    year, week = iso_weeks(dates)
+    month = dates.astype("datetime64[M]").astype(np.int64) % 12 + 1
+    key = (year * 100 + week) * 100 + month
+    starts = np.concatenate(([0], np.flatnonzero(key[1:] != key[:-1]) + 1))
+    ends = np.append(starts[1:], len(key))
+    maxes = {}
+    for period, selected in plot_periods(dates).items():
+        consumption = np.where(selected, columns["consumption"], -np.inf)
+        maxes[period] = np.maximum.reduceat(consumption, starts).round(2)
+    stats = []
+    for n, (start, end) in enumerate(zip(starts, ends)):
+        stats.append(
+            WeekStats(
+                Timestamp(int(year[start]), int(week[start]), int(month[start])),
+                values={name: values[start:end] for name, values in columns.items()},
+                **{
+                    f"max_{period}": None if max_[n] == -np.inf else float(max_[n])
+                    for period, max_ in maxes.items()
+                },
+            )
+        )
+    return stats
+
+
 #########################
 # Helper functions
 #########################
@@ -295,27 +510,103 @@ def db_add_user(dni, password, name):
         new_user = User(dni=dni, password=password, name=name)
         db.session.add(new_user)
         db.session.commit()
+        _user_ids.clear()
         return True
     except sqlite3.IntegrityError:
         raise Exception(f"Ya existe una cuenta con el DNI/NIE [{dni}] ")
 
 
-def add_reads(results: Dict[str, SingleReadData]):
-    """Add new read to db."""
+# DNI -> users.id, readings come with the DNI only
+_user_ids: Dict[str, int] = {}
 
-    dni, data = list(results.items())[0]
-    date, power, percent, max_power = data.to_tuple()
-    user = User.get_by_dni(dni)
-    read = Read(
-        instantaneous_consume=power,
-        percent=round(percent, 2),
-        max_power=max_power,
-        date=date,
-        weekend=is_weekend(date),
-        user=user,
+
+def user_id(dni: str) -> int:
+    """Id of the user with the DNI, None if the user doesn't exist."""
+    if dni not in _user_ids:
+        _user_ids.clear()
+        _user_ids.update(db.session.query(User.dni, User.id).all())
+    return _user_ids.get(dni)
+
+
+def ingest(readings: Iterable[Tuple[str, SingleReadData]]) -> int:
+    """Save a batch of (dni, reading) and update the rollups, in a single transaction.
+
+    Readings already saved are ignored. Returns the number of readings sent to the db.
+    """
+    rows, dnis = [], {}
+    for dni, data in readings:
+        id_ = user_id(dni)
+        if id_ is None:
+            continue  # user deleted while it was being read
+        dnis[id_] = dni
+        rows.append(
+            {
+                "user_id": id_,
+                "instantaneous_consume": data.power,
+                "percent": round(data.percent, 2),
+                "max_power": data.max_power,
+                "date": data.date,
+                "weekend": is_weekend(data.date),
+                "period": tariff_period(data.date),
+                "hour": data.date.hour,
+                "weekday": data.date.isoweekday(),
+            }
+        )
+    if rows:
+        new = _new_reads(rows)
+        db.session.execute(Read.__table__.insert().prefix_with("OR IGNORE"), rows)
+        if new:
+            db.session.execute(UPSERT_ROLLUP, rollup_rows(new))
+            _invalidate_weeks(new)
+        db.session.commit()
+        timeseries.add(new, dnis)
+        if new:
+            # weeks cached by a plot before the store got the new reads
+            _invalidate_weeks(new)
+            db.session.commit()
+    return len(rows)
+
+
+def _invalidate_weeks(rows: List[dict], connection=None):
+    """Drop the cached stats of the weeks of new reads, usually the current one.
+
+    Runs in the session, or in `connection` while it's being flushed.
+    """
+    first: Dict[int, datetime.datetime] = {}
+    for row in rows:
+        first[row["user_id"]] = min(first.get(row["user_id"], row["date"]), row["date"])
+    weeks = CachedWeek.__table__
+    for id_, date in first.items():
+        year, week, _ = date.isocalendar()
+        (connection or db.session).execute(
+            weeks.delete()
+            .where(weeks.c.user_id == id_)
+            .where(weeks.c.year * 100 + weeks.c.week >= year * 100 + week)
+        )
+
+
+def _new_reads(rows: List[dict]) -> List[dict]:
+    """Rows not saved yet, only these count in the rollups."""
+    saved = set(
+        db.session.query(Read.user_id, Read.date).filter(
+            Read.user_id.in_({row["user_id"] for row in rows}),
+            Read.date.between(
+                min(row["date"] for row in rows), max(row["date"] for row in rows)
+            ),
+        )
     )
-    db.session.add(read)
-    db.session.commit()
+    new = []
+    for row in rows:
+        key = (row["user_id"], row["date"])
+        if key not in saved:
+            saved.add(key)
+            new.append(row)
+    return new
+
+
+def add_reads(results: Dict[str, SingleReadData]):
+    """Add new reads to db."""
+    return ingest(results.items())
 
 
 def update_user(dni, updated: dict):
@@ -328,8 +619,12 @@ def update_user(dni, updated: dict):
 
 def delete_user(dni):
     user = User.get_by_dni(dni)
+    Rollup.query.filter_by(user_id=user.id).delete()
+    CachedWeek.query.filter_by(user_id=user.id).delete()
     db.session.delete(user)
     db.session.commit()
+    _user_ids.clear()
+    timeseries.remove(dni)
 
 
 def calculate_max_consumption_peak(data: list):
@@ -355,3 +650,18 @@ def is_weekend(dt: datetime.datetime):
     if dt.isoweekday() in weekend_days:
         return True
     return False
+
+
+def tariff_period(dt: datetime.datetime) -> str:
+    """Tariff period of a date, hours as [start, end).
+
+    valle: 0 - 8 and weekends, punta: 10 - 14 and 18 - 22, llana: the rest.
+    """
+    if dt.hour < 8 or is_weekend(dt):
+        return VALLE
+    if 10 <= dt.hour < 14 or 18 <= dt.hour < 22:
+        return PUNTA
+    return LLANA
+
+
+from ui import timeseries  # noqa isort:skip
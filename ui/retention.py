@@ -0,0 +1,170 @@
+"""Retention of the readings.
+
+Raw readings are kept in the database for `raw_days`. Older ones are moved to compressed
+columnar archives, one `.npz` per user and month, and only their rollups stay in the
+database: hourly ones for `hourly_days`, daily and weekly ones forever. The archives can
+still be read with `Retention.read` or `python -m ui.retention <dni> [start] [end]`.
+"""
+
+import datetime
+import os
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+
+from scrapper.contador import get_config, info_log
+from ui.app import db
+from ui.models import Read, Rollup, User
+
+COLUMNS = ("date", "consumption", "percent", "max_power", "period")
+
+
+def week_start(dt: datetime.datetime) -> datetime.datetime:
+    """Monday 00:00 of the week of a date."""
+    day = datetime.datetime.combine(dt.date(), datetime.time())
+    return day - datetime.timedelta(days=dt.isoweekday() - 1)
+
+
+@dataclass
+class Retention:
+    """Readings older than `raw_days` are archived in `path`."""
+
+    path: Path
+    raw_days: int = 90
+    hourly_days: int = 365
+
+    def cutoff(self, days: int, now: datetime.datetime = None) -> datetime.datetime:
+        """Start of the week `days` ago. Only whole weeks leave the database, so the
+        rollups of the archived readings are always complete."""
+        now = now or datetime.datetime.now()
+        return week_start(now - datetime.timedelta(days=days))
+
+    def apply(self, now: datetime.datetime = None) -> Dict[str, int]:
+        """Archive the old readings and drop the old hourly rollups."""
+        cutoff = self.cutoff(self.raw_days, now)
+        archived = 0
+        for user in User.query.all():
+            archived += self.archive(user, cutoff)
+        hourly = Rollup.query.filter(
+            Rollup.grain == "hour", Rollup.start < self.cutoff(self.hourly_days, now)
+        ).delete()
+        db.session.commit()
+        if archived or hourly:
+            info_log.info(
+                f"Retención: {archived} lecturas archivadas, "
+                f"{hourly} resúmenes por hora borrados"
+            )
+        return {"archived": archived, "hourly": hourly}
+
+    def archive(self, user: User, cutoff: datetime.datetime) -> int:
+        """Move the readings of a user before `cutoff` to the archives."""
+        rows = (
+            db.session.query(
+                Read.date,
+                Read.instantaneous_consume,
+                Read.percent,
+                Read.max_power,
+                Read.period,
+            )
+            .filter(Read.user_id == user.id, Read.date < cutoff)
+            .order_by(Read.date)
+            .all()
+        )
+        if not rows:
+            return 0
+        columns = _columns(rows)
+        months = columns["date"].astype("datetime64[M]")
+        for month in np.unique(months):
+            selected = months == month
+            self._merge(
+                self._file(user.dni, str(month)),
+                {name: values[selected] for name, values in columns.items()},
+            )
+        # the archive files are written, a crash from here on only archives them twice
+        Read.query.filter(Read.user_id == user.id, Read.date < cutoff).delete()
+        db.session.commit()
+        return len(rows)
+
+    def read(
+        self,
+        dni: str,
+        start: datetime.datetime = None,
+        end: datetime.datetime = None,
+    ) -> Dict[str, np.ndarray]:
+        """Archived readings of a user in [start, end), as columns sorted by date."""
+        files = sorted((self.path / dni).glob("*.npz"))
+        if start is not None:
+            files = [f for f in files if f.stem >= start.strftime("%Y-%m")]
+        if end is not None:
+            files = [f for f in files if f.stem <= end.strftime("%Y-%m")]
+        columns = _concat([_load(f) for f in files])
+        selected = np.ones(len(columns["date"]), dtype=bool)
+        if start is not None:
+            selected &= columns["date"] >= np.datetime64(start)
+        if end is not None:
+            selected &= columns["date"] < np.datetime64(end)
+        return {name: values[selected] for name, values in columns.items()}
+
+    def _file(self, dni: str, month: str) -> Path:
+        return self.path / dni / f"{month}.npz"
+
+    def _merge(self, path: Path, columns: Dict[str, np.ndarray]):
+        """Add readings to an archive file, replacing it atomically."""
+        if path.exists():
+            columns = _concat([_load(path), columns])
+        _, unique = np.unique(columns["date"], return_index=True)
+        columns = {name: values[unique] for name, values in columns.items()}
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".tmp.npz")
+        np.savez_compressed(tmp, **columns)
+        os.replace(tmp, path)
+
+
+def _columns(rows: List[tuple]) -> Dict[str, np.ndarray]:
+    date, consumption, percent, max_power, period = zip(*rows) if rows else [()] * 5
+    return {
+        "date": np.array(date, dtype="datetime64[s]"),
+        "consumption": np.array(consumption, dtype=float),
+        "percent": np.array(percent, dtype=float),
+        "max_power": np.array(max_power, dtype=float),
+        "period": np.array(period, dtype="U5"),
+    }
+
+
+def _load(path: Path) -> Dict[str, np.ndarray]:
+    with np.load(path) as f:
+        return {name: f[name] for name in COLUMNS}
+
+
+def _concat(parts: List[Dict[str, np.ndarray]]) -> Dict[str, np.ndarray]:
+    if not parts:
+        return _columns([])
+    return {name: np.concatenate([p[name] for p in parts]) for name in COLUMNS}
+
+
+def retention(cfg: dict = None) -> Retention:
+    """Retention policy of the `"retention"` config section."""
+    cfg = (cfg or get_config()).get("retention", {})
+    return Retention(
+        path=Path(__file__).parent / cfg.get("path", "archive"),
+        raw_days=cfg.get("raw_days", 90),
+        hourly_days=cfg.get("hourly_days", 365),
+    )
+
+
+if __name__ == "__main__":
+    # python -m ui.retention: apply the policy now
+    # python -m ui.retention <dni> [start] [end]: print the archived readings, ISO dates
+    import sys
+
+    args = sys.argv[1:]
+    if not args:
+        print(retention().apply())
+    else:
+        dates = [datetime.datetime.fromisoformat(a) for a in args[1:3]]
+        start, end = (dates + [None, None])[:2]
+        columns = retention().read(args[0], start, end)
+        for row in zip(*(columns[name] for name in COLUMNS)):
+            print(*row, sep="\t")
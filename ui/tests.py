@@ -1,8 +1,8 @@
 import datetime
 
+import numpy as np
 import pytest
 from sqlalchemy import extract, and_, or_
-import itertools
 
 from ui.graphs import (
     generate_graphic_axis,
@@ -10,10 +10,24 @@ from ui.graphs import (
     create_plot,
     create_barchart,
 )
-from ui.app import db
+from ui.app import (
+    app,
+    db,
+    db_maintenance,
+    export_csv,
+    historic_stats,
+    queue_claim,
+)
+from ui.migrations import BACKFILL_PERIOD, migrate, rebuild_rollups
 from ui.models import (
+    CachedWeek,
     Read,
+    Rollup,
     User,
+    add_reads,
+    column_stats,
+    ingest,
+    tariff_period,
     calculate_max_consumption_peak,
     calculate_min_consumption_peak,
     calculate_average_consumption,
@@ -21,7 +35,11 @@ from ui.models import (
     WeekStats,
     is_weekend,
 )
+from ui import benchmarks, timeseries
+from ui.retention import Retention
 from scrapper.contador import SingleReadData
+from scrapper.work_queue import WorkQueue
+from werkzeug.exceptions import BadRequest, Forbidden, NotFound
 
 
 @pytest.fixture(scope="module")
@@ -167,7 +185,7 @@ def test_punta_stats():
         "min_llana": "",
         "average_llana": "",
     }
-    historic_stats = Read.historic_stats(id_=1)
+    historic_stats = Rollup.historic_stats(id_=1)
     assert max_ > 0
     assert min_ < max_
     assert isinstance(historic_stats, dict)
@@ -187,9 +205,8 @@ def test_user_total_stats_by_week(user):
     stats = UserTotalStats(user).stats_by_week()
     assert isinstance(stats, list)
     assert isinstance(stats[0], WeekStats)
-    assert isinstance(stats[0].values, itertools._grouper)
-    for data in stats[0].values:
-        assert isinstance(data, Read)
+    assert set(stats[0].values) == set(timeseries.COLUMNS)
+    assert sum(len(week.values["date"]) for week in stats) == user.reads.count()
 
 
 def test_user_total_to_dict(user):
@@ -253,3 +270,369 @@ def test_add_results_into_db():
     assert last_insert.max_power == 2
     assert last_insert.percent == 2
     assert last_insert.weekend is False
+
+
+@pytest.fixture
+def new_user():
+    db.create_all()
+    migrate()
+    user = User(dni="00000000T", name="test", password="")
+    db.session.add(user)
+    db.session.commit()
+    yield user
+    Read.query.filter_by(user_id=user.id).delete()
+    Rollup.query.filter_by(user_id=user.id).delete()
+    CachedWeek.query.filter_by(user_id=user.id).delete()
+    db.session.delete(user)
+    db.session.commit()
+    timeseries.remove(user.dni)
+
+
+def test_ingest_batch_of_reads(new_user):
+    date = datetime.datetime(2020, 8, 8, 12, 0)
+    readings = [
+        ("00000000T", SingleReadData(date, 1.5, 45.456, 3.3)),
+        (
+            "00000000T",
+            SingleReadData(date + datetime.timedelta(minutes=10), 2, 60, 3.3),
+        ),
+        ("unknown", SingleReadData(date, 1, 1, 1)),
+    ]
+    assert ingest(readings) == 2
+    ingest(readings[:1])  # already saved, ignored
+    add_reads({"00000000T": readings[1][1]})
+    reads = new_user.reads.order_by(Read.date).all()
+    assert [r.instantaneous_consume for r in reads] == [1.5, 2]
+    assert reads[0].percent == 45.46
+    assert reads[0].weekend is True
+
+
+def test_tariff_period_matches_backfill(new_user):
+    start = datetime.datetime(2020, 8, 3)  # monday
+    dates = [start + datetime.timedelta(minutes=30 * n) for n in range(48 * 7)]
+    db.session.add_all(Read(date=date, user=new_user) for date in dates)
+    db.session.commit()
+    expected = [tariff_period(date) for date in dates]
+    assert [r.period for r in new_user.reads.order_by(Read.date)] == expected
+    # only the reads of the fixture user, the rest of the db keeps its periods
+    db.engine.execute(
+        "UPDATE reads SET period = NULL, hour = NULL, weekday = NULL "
+        "WHERE user_id = ?",
+        new_user.id,
+    )
+    for statement in BACKFILL_PERIOD.split(";"):
+        if statement.strip():
+            db.engine.execute(statement)
+    db.session.expire_all()
+    assert [r.period for r in new_user.reads.order_by(Read.date)] == expected
+    assert len(Read.get_hora_punta(new_user.id)) == 8 * 5 * 2
+    assert {r.hour for r in Read.get_hora_llana(new_user.id)} == {
+        8,
+        9,
+        14,
+        15,
+        16,
+        17,
+        22,
+        23,
+    }
+
+
+def rollups(user):
+    return [
+        (r.grain, r.start, r.period, r.count, r.sum, r.min, r.max)
+        for r in Rollup.query.filter_by(user_id=user.id).order_by(
+            Rollup.grain, Rollup.start, Rollup.period
+        )
+    ]
+
+
+def test_rollups_follow_ingest(new_user):
+    start = datetime.datetime(2020, 8, 31, 7)  # monday, august ends on the same week
+    readings = [
+        ("00000000T", SingleReadData(start + datetime.timedelta(hours=n), n, 1, 1))
+        for n in range(24 * 3)
+    ]
+    ingest(readings[:30])
+    ingest(readings)  # the first 30 are already saved, they don't count twice
+
+    incremental = rollups(new_user)
+    assert sum(r[3] for r in incremental if r[0] == "week") == 24 * 3
+    with db.engine.begin() as conn:
+        rebuild_rollups(conn)
+    assert rollups(new_user) == incremental
+
+    stats = Rollup.historic_stats(new_user.id)
+    assert stats["max"] == 71 and stats["min"] == 0 and stats["average"] == 35.5
+    assert stats["max_valle"] == 71 and stats["max_punta"] == 62  # 6:00 and 21:00
+    weeks = Rollup.weekly_max(new_user.id)
+    assert [(w["week"], w["month"]) for w in weeks] == [(36, 8), (36, 9)]
+    assert weeks[0]["max_punta"] == 14 and weeks[0]["max_valle"] == 0
+
+
+def test_rollups_follow_orm_reads(new_user):
+    start = datetime.datetime(2020, 8, 3, 7)  # monday
+    dates = [start + datetime.timedelta(hours=n) for n in range(24 * 14)]
+    ingest([("00000000T", SingleReadData(date, 1, 1, 1)) for date in dates[::2]])
+    UserTotalStats(new_user).stats_by_week()
+    assert CachedWeek.query.filter_by(user_id=new_user.id).count() == 2
+    # as ui/fake_data.py does, without going through `ingest`
+    db.session.add_all(
+        Read(
+            date=date,
+            user=new_user,
+            instantaneous_consume=n % 7,
+            percent=1,
+            max_power=1,
+        )
+        for n, date in enumerate(dates[1::2])
+    )
+    db.session.commit()
+    assert CachedWeek.query.filter_by(user_id=new_user.id).count() == 0
+
+    incremental = rollups(new_user)
+    assert sum(r[3] for r in incremental if r[0] == "week") == 24 * 14
+    with db.engine.begin() as conn:
+        rebuild_rollups(conn)
+    assert rollups(new_user) == incremental
+
+
+def test_retention_archives_old_reads(new_user, tmp_path):
+    start = datetime.datetime(2020, 1, 27)  # monday
+    readings = [
+        ("00000000T", SingleReadData(start + datetime.timedelta(hours=n), n, 1, 1))
+        for n in range(24 * 14)
+    ]
+    ingest(readings)
+    weekly = Rollup.weekly_max(new_user.id)
+    policy = Retention(tmp_path, raw_days=7, hourly_days=7)
+    # one week and a half ago, only the first week leaves the database
+    now = start + datetime.timedelta(days=14 + 3)
+    assert policy.apply(now)["archived"] == 24 * 7
+    assert new_user.reads.count() == 24 * 7
+    assert sorted(f.name for f in (tmp_path / "00000000T").iterdir()) == [
+        "2020-01.npz",
+        "2020-02.npz",
+    ]
+    assert policy.apply(now)["archived"] == 0
+
+    archived = policy.read("00000000T", start + datetime.timedelta(days=5))
+    assert archived["date"][0] == np.datetime64(start + datetime.timedelta(days=5))
+    assert archived["consumption"].tolist() == list(range(24 * 5, 24 * 7))
+    assert set(archived["period"]) == {"valle"}  # weekend
+    # the rollups of the archived week stay, and survive a rebuild
+    with db.engine.begin() as conn:
+        rebuild_rollups(conn)
+    assert Rollup.weekly_max(new_user.id) == weekly
+    assert Rollup.historic_stats(new_user.id)["min"] == 0
+
+
+def test_rebuild_keeps_rollups_archived_per_user(new_user, tmp_path):
+    other = User(dni="00000001R", name="test", password="")
+    db.session.add(other)
+    db.session.commit()
+    start = datetime.datetime(2020, 1, 6)  # monday
+    for dni in ("00000000T", "00000001R"):
+        ingest(
+            (dni, SingleReadData(start + datetime.timedelta(hours=n), n, 1, 1))
+            for n in range(24 * 21)
+        )
+
+    before = rollups(new_user), rollups(other)
+    # the other user has two weeks archived, the fixture user only one
+    policy = Retention(tmp_path, raw_days=0, hourly_days=0)
+    policy.archive(new_user, start + datetime.timedelta(days=7))
+    policy.archive(other, start + datetime.timedelta(days=14))
+    with db.engine.begin() as conn:
+        rebuild_rollups(conn)
+    try:
+        assert (rollups(new_user), rollups(other)) == before
+    finally:
+        Rollup.query.filter_by(user_id=other.id).delete()
+        db.session.delete(other)
+        db.session.commit()
+        timeseries.remove(other.dni)
+
+
+def test_timeseries_follow_ingest(new_user):
+    start = datetime.datetime(2020, 8, 3)
+    readings = [
+        (
+            "00000000T",
+            SingleReadData(start + datetime.timedelta(minutes=10 * n), n, 1, 2),
+        )
+        for n in range(100)
+    ]
+    ingest(readings[:10])
+    ingest(readings[20:])
+    ingest(readings[5:20])  # late and partly saved readings
+    columns = timeseries.store("00000000T").columns()
+    assert isinstance(columns["consumption"], np.memmap)
+    assert columns["consumption"].tolist() == list(range(100))
+    assert columns["date"][0] == np.datetime64(start)
+    assert set(columns["max_power"]) == {2}
+    codes = [timeseries.PERIODS[c] for c in columns["period"]]
+    assert codes == [r.period for r in new_user.reads.order_by(Read.date)]
+
+    timeseries.remove("00000000T")  # built again from the database
+    rebuilt = timeseries.store("00000000T").columns()
+    assert all(np.array_equal(rebuilt[name], columns[name]) for name in columns)
+
+
+def test_timeseries_see_orm_reads(new_user):
+    start = datetime.datetime(2020, 8, 3)
+    ingest([("00000000T", SingleReadData(start, 1, 1, 1))])
+    assert len(timeseries.store("00000000T")) == 1
+    # as ui/fake_data.py does, without going through `ingest`
+    db.session.add(
+        Read(
+            date=start + datetime.timedelta(minutes=10),
+            user=new_user,
+            instantaneous_consume=2,
+            percent=1,
+            max_power=1,
+        )
+    )
+    db.session.commit()
+    columns = timeseries.store("00000000T").columns()
+    assert columns["consumption"].tolist() == [1, 2]
+
+
+def test_column_stats(new_user):
+    start = datetime.datetime(2020, 8, 3)  # monday
+    assert set(column_stats(timeseries.empty()).values()) == {None}
+    readings = [
+        ("00000000T", SingleReadData(start + datetime.timedelta(hours=n), n, 1, 1))
+        for n in range(24 * 7)
+    ]
+    ingest(readings)
+    columns = timeseries.store("00000000T").columns()
+    stats = column_stats(columns)
+    assert stats == Rollup.historic_stats(new_user.id)
+    punta = [r.instantaneous_consume for r in Read.get_hora_punta(new_user.id)]
+    assert stats["max_punta"] == max(punta) and stats["min_punta"] == min(punta)
+    assert stats["average_punta"] == round(sum(punta) / len(punta), 2)
+
+    saturday = start + datetime.timedelta(days=5)
+    weekend = column_stats(columns, start=saturday)
+    assert weekend["min"] == weekend["min_valle"] == 24 * 5
+    assert weekend["max_punta"] is None and weekend["average_llana"] is None
+    monday = column_stats(columns, end=start + datetime.timedelta(days=1))
+    assert monday["max"] == 23 and monday["max_punta"] == 21
+
+
+def test_week_stats_match_rows(new_user):
+    start = datetime.datetime(2020, 12, 21)  # monday, the ISO year 2020 has 53 weeks
+    rows = [
+        benchmarks.Row(start + datetime.timedelta(minutes=10 * n), n % 97 / 10)
+        for n in range(6 * 24 * 21)
+    ]
+    ingest(("00000000T", SingleReadData(r.date, r[1], 1, 1)) for r in rows)
+    stats = UserTotalStats(new_user).to_dict()
+    assert stats == benchmarks.rows_week_stats(rows)
+    assert UserTotalStats(new_user).to_dict() == stats  # from the cache
+    assert [(s["year"], s["week"], s["month"]) for s in stats] == [
+        (2020, 52, 12),
+        (2020, 53, 12),
+        (2020, 53, 1),
+        (2021, 1, 1),
+    ]
+
+
+def test_week_stats_cache(new_user):
+    start = datetime.datetime(2020, 8, 3)  # monday
+    rows = [
+        benchmarks.Row(start + datetime.timedelta(minutes=10 * n), n % 89 / 10)
+        for n in range(6 * 24 * 21)
+    ]
+    readings = [("00000000T", SingleReadData(r.date, r[1], 1, 1)) for r in rows]
+    ingest(readings[:-10])
+
+    def cached():
+        query = CachedWeek.query.filter_by(user_id=new_user.id)
+        return [(w.year, w.week, w.month) for w in query.order_by(CachedWeek.week)]
+
+    first = UserTotalStats(new_user).stats_by_week()
+    assert cached() == [(2020, 32, 8), (2020, 33, 8)]  # the last week is still open
+    ingest(readings[-10:])  # new readings of the open week keep the closed ones
+    stats = UserTotalStats(new_user).stats_by_week()
+    assert cached() == [(2020, 32, 8), (2020, 33, 8)]
+    assert [len(w.values["date"]) for w in stats] == [6 * 24 * 7] * 3
+    assert stats[0].values["date"][0] == first[0].values["date"][0]
+    assert UserTotalStats(new_user).to_dict() == benchmarks.rows_week_stats(rows)
+
+    late = SingleReadData(start + datetime.timedelta(days=8, seconds=1), 50, 1, 1)
+    add_reads({"00000000T": late})  # drops the week of the reading and the next ones
+    assert cached() == [(2020, 32, 8)]
+    assert UserTotalStats(new_user).to_dict()[1]["max_valle"] == 50
+
+
+def test_week_stats_cache_during_ingest(new_user, monkeypatch):
+    start = datetime.datetime(2020, 8, 3)  # monday
+    ingest(
+        ("00000000T", SingleReadData(start + datetime.timedelta(hours=n), 1, 1, 1))
+        for n in range(24 * 14)
+    )
+    add = timeseries.add
+
+    def plot_before_add(rows, dnis):
+        UserTotalStats(new_user).stats_by_week()  # a plot between commit and append
+        add(rows, dnis)
+
+    monkeypatch.setattr(timeseries, "add", plot_before_add)
+    late = SingleReadData(start + datetime.timedelta(hours=1, minutes=30), 50, 1, 1)
+    add_reads({"00000000T": late})
+    assert UserTotalStats(new_user).to_dict()[0]["max_valle"] == 50
+
+
+def test_worker_endpoints_need_the_token(monkeypatch):
+    cfg = {"queue": {"token": ""}}
+    monkeypatch.setattr("ui.app.get_config", lambda: cfg)
+    body = {"worker": "w1", "n": 1}
+    for token, headers in (("", {}), ("", {"X-Queue-Token": ""}), ("s3cr3t", {})):
+        cfg["queue"]["token"] = token
+        with app.test_request_context(json=body, headers=headers):
+            with pytest.raises(Forbidden):
+                queue_claim()
+    monkeypatch.setattr("ui.app.work_queue.local_queue", lambda: WorkQueue(":memory:"))
+    with app.test_request_context(json=body, headers={"X-Queue-Token": "s3cr3t"}):
+        assert queue_claim().get_json() == {"users": []}
+
+
+def test_historic_stats_range_includes_archived(new_user, monkeypatch, tmp_path):
+    start = datetime.datetime(2020, 8, 3)  # monday
+    ingest(
+        ("00000000T", SingleReadData(start + datetime.timedelta(hours=n), n, 1, 1))
+        for n in range(24 * 14)
+    )
+    policy = Retention(tmp_path)
+    monkeypatch.setattr("ui.timeseries.retention", lambda: policy)
+    timeseries.remove("00000000T")
+    policy.archive(new_user, start + datetime.timedelta(days=7))
+    url = "/historic_stats/00000000T?start=2020-08-03&end=2020-08-04"
+    with app.test_request_context(url):
+        stats = historic_stats("00000000T")
+    assert stats["min"] == 0 and stats["max"] == 23 and stats["max_punta"] == 21
+    assert stats["min_valle"] == 0 and stats["average_llana"] is not None
+    with app.test_request_context("/historic_stats/00000000T?start=ayer"):
+        with pytest.raises(BadRequest):
+            historic_stats("00000000T")
+
+
+def test_stores_only_for_known_users():
+    with app.test_request_context("/export_csv/.csv"):
+        with pytest.raises(NotFound):
+            export_csv(".csv")
+    with app.test_request_context("/historic_stats/..?start=2020-08-03"):
+        with pytest.raises(NotFound):
+            historic_stats("..")
+    for dni in ("", ".."):
+        with pytest.raises(ValueError):
+            timeseries.store(dni)
+
+
+def test_sqlite_connections_use_wal():
+    with db.engine.connect() as conn:
+        assert conn.execute("PRAGMA journal_mode").scalar() == "wal"
+        assert conn.execute("PRAGMA busy_timeout").scalar() > 0
+    db_maintenance()
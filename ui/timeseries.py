@@ -0,0 +1,206 @@
+"""Columnar store of the readings of every user, for the analytics.
+
+One raw array file per column in `ui/timeseries/<dni>/`, sorted by date. `ingest` appends
+the new readings to them, and `TimeSeries.columns` maps them in memory, so the stats of
+years of readings are computed on numpy arrays without building a `Read` per reading.
+The store of a user is built from the database and the archives the first time it's used.
+"""
+
+import logging
+import shutil
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+
+from scrapper.contador import get_config
+from ui.app import db
+from ui.models import LLANA, PUNTA, VALLE, Read, User
+from ui.retention import retention
+
+COLUMNS = {
+    "date": np.dtype("<M8[s]"),
+    "consumption": np.dtype("<f8"),
+    "percent": np.dtype("<f8"),
+    "max_power": np.dtype("<f8"),
+    "period": np.dtype("u1"),  # index in PERIODS
+}
+PERIODS = (PUNTA, LLANA, VALLE)
+
+log = logging.getLogger(__name__)
+_lock = threading.Lock()
+
+
+@dataclass
+class TimeSeries:
+    """Readings of a user as parallel arrays."""
+
+    path: Path
+
+    def exists(self) -> bool:
+        return self.path.is_dir()
+
+    def __len__(self) -> int:
+        if not self.exists():
+            return 0
+        # a crash in the middle of an append can leave some columns longer
+        return min(
+            self._file(name).stat().st_size // dtype.itemsize
+            for name, dtype in COLUMNS.items()
+        )
+
+    def columns(self) -> Dict[str, np.ndarray]:
+        """Read only arrays mapped on the files, no copies."""
+        n = len(self)
+        if not n:
+            return empty()
+        return {
+            name: np.memmap(self._file(name), dtype=dtype, mode="r", shape=(n,))
+            for name, dtype in COLUMNS.items()
+        }
+
+    def append(self, columns: Dict[str, np.ndarray]):
+        """Add readings not stored yet."""
+        order = np.argsort(columns["date"], kind="stable")
+        columns = {name: columns[name][order] for name in COLUMNS}
+        with _lock:
+            n = len(self)
+            stored = self.columns()
+            if n and columns["date"][0] <= stored["date"][-1]:
+                # late readings, the arrays are merged to keep them sorted
+                self.write(concat([stored, columns]))
+                return
+            for name, dtype in COLUMNS.items():
+                with open(self._file(name), "r+b") as f:
+                    f.truncate(n * dtype.itemsize)
+                    f.seek(0, 2)
+                    f.write(columns[name].astype(dtype).tobytes())
+
+    def write(self, columns: Dict[str, np.ndarray]):
+        """Replace the store with the readings given, sorted and without duplicates."""
+        _, unique = np.unique(columns["date"], return_index=True)
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        shutil.rmtree(tmp, ignore_errors=True)
+        tmp.mkdir(parents=True)
+        for name, dtype in COLUMNS.items():
+            columns[name][unique].astype(dtype).tofile(str(tmp / name))
+        shutil.rmtree(self.path, ignore_errors=True)
+        tmp.rename(self.path)
+
+    def _file(self, name: str) -> Path:
+        return self.path / name
+
+
+def empty() -> Dict[str, np.ndarray]:
+    return {name: np.empty(0, dtype=dtype) for name, dtype in COLUMNS.items()}
+
+
+def concat(parts: List[Dict[str, np.ndarray]]) -> Dict[str, np.ndarray]:
+    return {name: np.concatenate([p[name] for p in parts]) for name in COLUMNS}
+
+
+def from_rows(rows: List[dict]) -> Dict[str, np.ndarray]:
+    """Columns of `ingest` rows."""
+    return {
+        "date": np.array([r["date"] for r in rows], dtype=COLUMNS["date"]),
+        "consumption": np.array(
+            [r["instantaneous_consume"] for r in rows], dtype=float
+        ),
+        "percent": np.array([r["percent"] for r in rows], dtype=float),
+        "max_power": np.array([r["max_power"] for r in rows], dtype=float),
+        "period": period_codes(np.array([r["period"] for r in rows], dtype="U5")),
+    }
+
+
+def period_codes(periods: np.ndarray) -> np.ndarray:
+    codes = np.zeros(len(periods), dtype=COLUMNS["period"])
+    for code, period in enumerate(PERIODS):
+        codes[periods == period] = code
+    return codes
+
+
+def _root() -> Path:
+    path = get_config().get("timeseries", {}).get("path", "timeseries")
+    return Path(__file__).parent / path
+
+
+def _path(dni: str) -> Path:
+    # the store is deleted and rewritten, it must be a directory of the root
+    if not dni or dni in (".", "..") or "/" in dni or "\\" in dni:
+        raise ValueError(f"DNI no valido: {dni!r}")
+    return _root() / dni
+
+
+def store(dni: str) -> TimeSeries:
+    """Store of a user, built if it doesn't exist yet or misses reads of the db."""
+    series = TimeSeries(_path(dni))
+    if not series.exists() or not _in_sync(dni, series):
+        build(dni, series)
+    return series
+
+
+def _in_sync(dni: str, series: TimeSeries) -> bool:
+    """Whether the store has as many readings as the db since its first one. Reads
+    saved without `ingest`, as the ORM ones, are only found this way."""
+    count, first = (
+        db.session.query(db.func.count(Read.id), db.func.min(Read.date))
+        .join(User)
+        .filter(User.dni == dni)
+        .one()
+    )
+    if not count:
+        return True  # archived or deleted, the store keeps them
+    dates = series.columns()["date"]
+    return len(dates) - np.searchsorted(dates, np.datetime64(first)) == count
+
+
+def build(dni: str, series: TimeSeries):
+    """Fill the store of a user from the archives and the database."""
+    archived = retention().read(dni)
+    archived["period"] = period_codes(archived["period"])
+    rows = (
+        db.session.query(
+            Read.date,
+            Read.instantaneous_consume,
+            Read.percent,
+            Read.max_power,
+            Read.period,
+        )
+        .join(User)
+        .filter(User.dni == dni)
+        .all()
+    )
+    keys = ("date", "instantaneous_consume", "percent", "max_power", "period")
+    saved = from_rows([dict(zip(keys, row)) for row in rows]) if rows else empty()
+    with _lock:
+        series.write(concat([archived, saved]))
+
+
+def add(rows: List[dict], dnis: Dict[int, str]):
+    """Append the rows just saved by `ingest` to the stores of their users."""
+    for user_id, dni in dnis.items():
+        user_rows = [row for row in rows if row["user_id"] == user_id]
+        series = TimeSeries(_path(dni))
+        if not user_rows:
+            continue
+        try:
+            if series.exists():
+                series.append(from_rows(user_rows))
+            else:  # the database has the new rows already
+                build(dni, series)
+        except OSError:
+            # built again from the database the next time
+            log.exception(f"[{dni}] Error guardando las lecturas en columnas")
+            shutil.rmtree(series.path, ignore_errors=True)
+
+
+def remove(dni: str):
+    """Delete the store of a user."""
+    shutil.rmtree(_path(dni), ignore_errors=True)
+
+
+def remove_all():
+    """Delete the stores of every user, they are built again when used."""
+    shutil.rmtree(_root(), ignore_errors=True)